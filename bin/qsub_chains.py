@@ -0,0 +1,114 @@
+# Published under the BSD 3-clause licence.
+
+"""Concurrent submission of many independent job chains.
+
+Used by ``qsub_dependents.py --chains``; kept in its own module because
+asyncio needs Python 3 while qsub_dependents.py itself also runs under
+Python 2.
+"""
+import asyncio
+
+from qsub_dependents import (DEFAULT_QUEUING_SYSTEM, get_jobid,
+                             dependent_job_args)
+
+class RateLimiter(object):
+    """Space out coroutines so that at most *rate* pass per second.
+
+    A *rate* of ``None`` or 0 disables the limit.
+    """
+    def __init__(self, rate=None):
+        self.interval = 1./rate if rate else 0.
+        self._next = 0.
+
+    async def wait(self):
+        if not self.interval:
+            return
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        # reserve the next free slot before sleeping so that concurrent
+        # callers queue up behind each other
+        slot = max(now, self._next)
+        self._next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+async def qsub_async(args, queuing_system=DEFAULT_QUEUING_SYSTEM,
+                     semaphore=None, limiter=None):
+    """Submit job with ``qsub args`` as an asyncio subprocess.
+
+    At most as many submissions as *semaphore* allows run at the same
+    time and *limiter* (a :class:`RateLimiter`) throttles the rate at
+    which they are started. Returns the jobid.
+    """
+    if queuing_system == "SLURM":
+        base_cmd = "sbatch"
+    else:
+        base_cmd = "qsub"
+
+    cmd = [base_cmd] + args
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(1)
+    async with semaphore:
+        # take the rate slot only once we may run, otherwise tasks that
+        # waited for the semaphore would start in bursts
+        if limiter is not None:
+            await limiter.wait()
+        print(">> " + " ".join(cmd))
+        p = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        output, errmsg = await p.communicate()
+    if p.returncode != 0:
+        raise OSError(p.returncode, "command %r failed: %s" % (" ".join(cmd), errmsg))
+    output = output.decode("utf8")
+    jobid = get_jobid(output, queuing_system)
+    if not jobid:
+        # without a jobid the next segment would depend on nothing
+        raise OSError("cannot find the jobid in the output of %r: %r"
+                      % (" ".join(cmd), output))
+    return jobid
+
+async def qsub_chain_async(args, num_jobs, jobid=None,
+                           queuing_system=DEFAULT_QUEUING_SYSTEM,
+                           semaphore=None, limiter=None):
+    """Submit a chain of *num_jobs* dependent jobs with *args*.
+
+    Each segment is only submitted once its predecessor has a jobid so
+    that the dependency order is kept. Returns the list of jobids.
+    """
+    jobids = []
+    for ijob in range(int(num_jobs)):
+        if jobid is not None:
+            new_args = dependent_job_args(jobid, queuing_system) + args
+        else:
+            new_args = args
+        try:
+            jobid = await qsub_async(new_args, queuing_system=queuing_system,
+                                     semaphore=semaphore, limiter=limiter)
+        except OSError as err:
+            # keep track of the segments that did make it into the queue
+            err.jobids = jobids
+            raise
+        jobids.append(jobid)
+    return jobids
+
+def qsub_chains(chains, num_jobs, queuing_system=DEFAULT_QUEUING_SYSTEM,
+                max_concurrent=8, rate=None):
+    """Submit many independent chains of dependent jobs concurrently.
+
+    *chains* is a list of qsub argument lists, one per chain. Segments
+    of different chains are submitted in parallel, with at most
+    *max_concurrent* qsub processes at a time and at most *rate*
+    submissions per second.
+
+    Returns a list with one entry per chain: the list of jobids or the
+    exception that stopped the chain.
+    """
+    async def run():
+        semaphore = asyncio.Semaphore(max_concurrent)
+        limiter = RateLimiter(rate)
+        tasks = [qsub_chain_async(args, num_jobs, queuing_system=queuing_system,
+                                  semaphore=semaphore, limiter=limiter)
+                 for args in chains]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    return asyncio.run(run())
@@ -28,6 +28,28 @@ Examples:
 Adding three more jobs after a running one with jobid 12345.nid000016:
  
    %prog -N 3 -a 12345.nid000016 run.pbs
+
+Submitting many independent chains at once (e.g. one per replica): put
+the qsub arguments for each chain on its own line of a chain file and
+run
+
+   %prog -N 5 --chains replicas.txt -j 16 --rate 4
+
+The queuing system is only probed once and the chains are submitted
+concurrently; within a chain the dependency order is preserved. Any
+qsub-options given on the command line are prepended to every chain.
+
+With --record FILE the submitted chains are saved so that they can be
+checked later. If a segment fails (e.g. because it ran out of walltime)
+all later segments wait forever for their dependency. Such broken
+chains are found with
+
+   %prog --monitor --record FILE [--repair] [--interval SECONDS]
+
+(or %prog --monitor JOBID JOBID ... for a chain given by its job ids).
+--repair cancels the dead tail of each broken chain and resubmits the
+failed and cancelled segments so that the chain continues from its
+last checkpoint. A chain is resubmitted at most --max-retries times.
  
 """
 from __future__ import print_function
@@ -36,6 +58,9 @@ from six.moves import range
  
 import distutils.spawn
 import subprocess
+import json
+import shlex
+import time
 import re
  
 DEFAULT_QUEUING_SYSTEM = "PBS"
@@ -132,6 +157,323 @@ def dependent_job_args(jobid, queuing_system):
                  'SLURM': ["--dependency=afterok:%s" % jobid],
                  }
     return templates[queuing_system]
+
+# states reported by query_states(); ERROR is a failed job that is still
+# in the queue (GE Eqw)
+PENDING, HELD, NEVER, RUNNING, DONE, FAILED, ERROR, UNKNOWN = (
+    "pending", "held", "never", "running", "done", "failed", "error", "unknown")
+
+def write_record(filename, chains, jobids, queuing_system, submitted=None):
+    """Save submitted chains to the submission record *filename*.
+
+    *chains* is a list of qsub argument lists and *jobids* the
+    corresponding lists of submitted jobids; *submitted* is the time the
+    submission started (default: now).
+    """
+    record = {'queuing_system': queuing_system,
+              'submitted': submitted or time.time(),
+              'chains': [{'args': args, 'jobids': ids}
+                         for args, ids in zip(chains, jobids)],
+              }
+    with open(filename, "w") as f:
+        json.dump(record, f, indent=2)
+    return record
+
+def read_record(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+def _run(cmd):
+    """Run *cmd* and return its standard output (empty if it fails to start)."""
+    try:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return ""
+    out, err = p.communicate()
+    return out.decode("utf8")
+
+def _qacct(jobids, since=None):
+    """Return ``{jobid: (exit_status, failed)}`` from the GE accounting.
+
+    A single ``qacct`` call covers all *jobids*; *since* (seconds since
+    the epoch) restricts it to jobs that started later.
+    """
+    cmd = ["qacct", "-j"]
+    if since:
+        cmd += ["-b", time.strftime("%Y%m%d%H%M", time.localtime(since))]
+    wanted = set(jobids)
+    accounting = {}
+    info = {}
+    for line in _run(cmd).splitlines() + ["===="]:
+        if line.startswith("===="):
+            # a job may be listed more than once (reruns); keep the last
+            if info.get("jobnumber") in wanted and "exit_status" in info:
+                accounting[info["jobnumber"]] = (info["exit_status"],
+                                                 info.get("failed", "0").split()[0])
+            info = {}
+            continue
+        fields = line.split(None, 1)
+        if len(fields) == 2:
+            info[fields[0]] = fields[1].strip()
+    return accounting
+
+def query_states(jobids, queuing_system, since=None):
+    """Return a dict with the state of each of *jobids*.
+
+    The scheduler is asked about all jobs at once (GE needs one more
+    ``qacct`` call for jobs that already left the queue, restricted to
+    jobs started after *since* if given). States are PENDING, HELD,
+    NEVER (dependency can never be satisfied), RUNNING, DONE, FAILED or
+    UNKNOWN, or ERROR for a GE job in error state.
+    """
+    jobids = [str(j) for j in jobids]
+    states = dict((j, UNKNOWN) for j in jobids)
+    if not jobids:
+        return states
+    if queuing_system == "SLURM":
+        out = _run(["sacct", "-n", "-X", "-P", "-o", "JobID,State", "-j", ",".join(jobids)])
+        for line in out.splitlines():
+            fields = line.split("|")
+            if len(fields) < 2 or fields[0] not in states:
+                continue
+            state = fields[1].split()[0] if fields[1] else ""
+            if state == "COMPLETED":
+                states[fields[0]] = DONE
+            elif state in ("RUNNING", "COMPLETING", "SUSPENDED", "REQUEUED"):
+                states[fields[0]] = RUNNING
+            elif state == "PENDING":
+                states[fields[0]] = PENDING
+            elif state:
+                states[fields[0]] = FAILED
+        pending = [j for j in jobids if states[j] == PENDING]
+        if pending:
+            out = _run(["squeue", "-h", "-o", "%i %r", "-j", ",".join(pending)])
+            for line in out.splitlines():
+                fields = line.split()
+                if len(fields) < 2 or fields[0] not in states:
+                    continue
+                if fields[1] == "DependencyNeverSatisfied":
+                    states[fields[0]] = NEVER
+                elif fields[1].startswith("JobHeld"):
+                    states[fields[0]] = HELD
+    elif queuing_system == "PBS":
+        out = _run(["qstat", "-f"] + jobids)
+        jobid = None
+        for line in out.splitlines():
+            line = line.strip()
+            if line.startswith("Job Id:"):
+                jobid = line.split(":", 1)[1].strip()
+                if jobid not in states:
+                    # qstat may report a shortened or extended job id
+                    jobid = next((j for j in jobids if j.split(".")[0] == jobid.split(".")[0]), None)
+                continue
+            if jobid is None or "=" not in line:
+                continue
+            key, value = [x.strip() for x in line.split("=", 1)]
+            if key == "job_state":
+                states[jobid] = {"Q": PENDING, "W": PENDING, "H": HELD,
+                                 "R": RUNNING, "E": RUNNING, "C": DONE}.get(value, UNKNOWN)
+            elif key == "exit_status" and value != "0":
+                states[jobid] = FAILED
+    elif queuing_system == "GE":
+        out = _run(["qstat"])
+        for line in out.splitlines():
+            fields = line.split()
+            if len(fields) < 5 or fields[0] not in states:
+                continue
+            state = fields[4]
+            if "E" in state:
+                states[fields[0]] = ERROR
+            elif "h" in state:
+                states[fields[0]] = HELD
+            elif "r" in state or "t" in state or "s" in state.lower():
+                states[fields[0]] = RUNNING
+            else:
+                states[fields[0]] = PENDING
+        finished = [j for j in jobids if states[j] == UNKNOWN]
+        if finished:
+            for jobid, (exit_status, failed) in _qacct(finished, since).items():
+                states[jobid] = DONE if exit_status == "0" and failed == "0" else FAILED
+    else:
+        raise ValueError("Unknown queuing system %r" % queuing_system)
+    return states
+
+def find_break(jobids, states, queuing_system=None):
+    """Find where a chain of *jobids* is broken.
+
+    Returns ``(index, tail)``: the index of the first failed segment (or
+    ``None`` if the chain is healthy) and the list of later jobids that
+    are still waiting and will never start. The index is -1 if the first
+    segment can never start (its own dependency failed).
+
+    A chain that continued past a failed segment is not broken. GE
+    releases ``-hold_jid`` dependents whatever the exit status, so on GE
+    only a segment in error state, or a failed one whose successor is
+    still held, stops the chain.
+    """
+    for i, jobid in enumerate(jobids):
+        state = states.get(jobid, UNKNOWN)
+        if state == NEVER:
+            # the predecessor failed but has already left the scheduler
+            i -= 1
+            break
+        if state not in (FAILED, ERROR):
+            continue
+        later = [states.get(j, UNKNOWN) for j in jobids[i+1:]]
+        if RUNNING in later or DONE in later:
+            continue
+        if (queuing_system == "GE" and state == FAILED and
+                later and later[0] != HELD):
+            continue
+        break
+    else:
+        return None, []
+    tail = [j for j in jobids[i+1:] if states.get(j, UNKNOWN) in (PENDING, HELD, NEVER)]
+    return i, tail
+
+def end_time(jobid, queuing_system):
+    """Return the time (seconds since the epoch) *jobid* ended, or ``None``."""
+    if queuing_system == "SLURM":
+        out = _run(["sacct", "-n", "-X", "-P", "-o", "End", "-j", str(jobid)]).strip()
+        formats = ["%Y-%m-%dT%H:%M:%S"]
+    elif queuing_system == "PBS":
+        # TORQUE gives the completion time in seconds since the epoch
+        m = re.search(r"comp_time = (\d+)", _run(["qstat", "-f", str(jobid)]))
+        return float(m.group(1)) if m else None
+    else:
+        out = ""
+        for line in _run(["qacct", "-j", str(jobid)]).splitlines():
+            if line.startswith("end_time"):
+                out = line.split(None, 1)[1].strip().split(".")[0]
+        formats = ["%a %b %d %H:%M:%S %Y", "%Y-%m-%d %H:%M:%S"]
+    for fmt in formats:
+        try:
+            return time.mktime(time.strptime(out, fmt))
+        except ValueError:
+            pass
+    return None
+
+def cancel(jobids, queuing_system):
+    """Remove all *jobids* from the queue with a single command."""
+    if not jobids:
+        return True
+    cmd = ["scancel"] if queuing_system == "SLURM" else ["qdel"]
+    return subprocess.call(cmd + list(jobids)) == 0
+
+def submit_segments(chain, num_jobs, jobid, queuing_system):
+    """Submit *num_jobs* segments of *chain* after *jobid*.
+
+    A failed submission is reported and the number of segments that are
+    still missing is kept in ``chain['missing']``. Returns the jobids of
+    the submitted segments.
+    """
+    new_jobids = []
+    try:
+        for ijob in range(num_jobs):
+            jobid = qsub_dependents(chain['args'], jobid=jobid, queuing_system=queuing_system)
+            if not jobid:
+                raise OSError("qsub did not report a jobid")
+            new_jobids.append(jobid)
+    except OSError as err:
+        print("EE chain %s: submission failed after %d of %d segments: %s"
+              % ((chain['jobids'] or ["-"])[0], len(new_jobids), num_jobs, err))
+    missing = num_jobs - len(new_jobids)
+    if missing:
+        chain['missing'] = missing
+    else:
+        chain.pop('missing', None)
+    return new_jobids
+
+def monitor_chains(record, queuing_system, repair=False, max_retries=3, known=None):
+    """Check all chains in *record* once and optionally repair them.
+
+    Broken chains get their dead tail (and a failed segment still in the
+    queue) cancelled and the failed and cancelled segments resubmitted as
+    a new chain, at most *max_retries* times per chain; the jobids and
+    ``retries`` in *record* are updated accordingly, also for the
+    segments submitted before a submission failed. DONE and FAILED states are final; they are kept in the
+    dict *known* so that repeated checks do not ask for them again.
+    Returns the number of broken chains.
+    """
+    chains = record['chains']
+    if known is None:
+        known = {}
+    jobids = [j for c in chains for j in c['jobids'] if j not in known]
+    states = query_states(jobids, queuing_system, since=record.get('submitted'))
+    known.update((j, s) for j, s in states.items() if s in (DONE, FAILED))
+    states.update(known)
+    now = time.time()
+    broken = 0
+    released = 0
+    blocked = 0.
+    for chain in chains:
+        jobids = chain['jobids']
+        index, tail = find_break(jobids, states, queuing_system)
+        if index is None:
+            chain.pop('broken', None)
+            if repair and chain.get('missing'):
+                # finish a resubmission that failed part of the way
+                jobid = jobids[-1] if jobids else None
+                new_jobids = submit_segments(chain, chain['missing'], jobid, queuing_system)
+                chain['jobids'] = jobids = jobids + new_jobids
+            done = len([j for j in jobids if states.get(j) == DONE])
+            print("-- chain %s: %d of %d segments done" % (jobids[0] if jobids else "-", done, len(jobids)))
+            continue
+        broken += 1
+        chain.setdefault('broken', now)
+        print("WW chain %s: segment %d (%s) failed, %d segments will never start"
+              % (jobids[0], index + 1, jobids[index] if index >= 0 else "-", len(tail)))
+        if not repair:
+            continue
+        if chain.get('retries', 0) >= max_retries:
+            print("EE chain %s: not resubmitted, already retried %d times"
+                  % (jobids[0], chain['retries']))
+            continue
+        dead = list(tail)
+        if index >= 0 and states[jobids[index]] == ERROR:
+            dead.insert(0, jobids[index])
+        if not cancel(dead, queuing_system):
+            print("EE could not cancel %s" % " ".join(dead))
+            continue
+        released += len(tail)
+        # the dead segments are blocked since the failure (or, if its time
+        # is unknown, since the monitor first saw the chain broken)
+        submitted = chain.get('submitted', record.get('submitted', now))
+        failed_at = None
+        if index >= 0 and states[jobids[index]] != ERROR:
+            failed_at = end_time(jobids[index], queuing_system)
+        failed_at = failed_at or chain.get('broken', now)
+        blocked += len(tail) * (now - max(failed_at, submitted))
+        # rerun the failed segment and everything after it
+        num_jobs = len(jobids) - max(index, 0)
+        new_jobids = submit_segments(chain, num_jobs, None, queuing_system)
+        chain['jobids'] = jobids[:max(index, 0)] + new_jobids
+        chain['submitted'] = time.time()
+        chain['retries'] = chain.get('retries', 0) + 1
+        chain.pop('broken', None)
+        if new_jobids:
+            print("-- chain resubmitted as %s" % " ".join(new_jobids))
+    if released:
+        print("-- released %d dead segments (%.1f h of blocked queue time in total)"
+              % (released, blocked / 3600.))
+    return broken
+
+def read_chains(filename, common_args=None):
+    """Read the qsub arguments of one chain per line from *filename*.
+
+    Empty lines and lines starting with '#' are skipped. Each line is
+    split like a shell command line; *common_args* are prepended to
+    every chain.
+    """
+    common_args = list(common_args or [])
+    chains = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            chains.append(common_args + shlex.split(line))
+    return chains
  
  
 if __name__ == "__main__":
@@ -157,9 +499,66 @@ if __name__ == "__main__":
                  default=None,
                  help="make the first job dependent on an already running job "
                  "with job id JOBID. (Typically used in conjunction with --number.)")
+    p.add_option("--chains", dest="chains", metavar="FILE",
+                 default=None,
+                 help="submit one independent chain for each line of FILE; a line "
+                 "contains the qsub-options and queuing script of that chain")
+    p.add_option("-j", "--max-concurrent", dest="max_concurrent", type="int", metavar="N",
+                 default=8,
+                 help="with --chains, run at most N submissions at the same time [%default]")
+    p.add_option("--rate", dest="rate", type="float", metavar="RATE",
+                 default=5.,
+                 help="with --chains, submit at most RATE jobs per second; "
+                 "0 means no limit [%default]")
+    p.add_option("--record", dest="record", metavar="FILE",
+                 default=None,
+                 help="save the submitted job ids to FILE; with --monitor, "
+                 "check the chains saved in FILE")
+    p.add_option("--monitor", dest="monitor", action="store_true",
+                 default=False,
+                 help="check chains given by --record FILE or by their job ids "
+                 "(the arguments) for failed segments")
+    p.add_option("--repair", dest="repair", action="store_true",
+                 default=False,
+                 help="with --monitor and --record, cancel the dead tail of broken "
+                 "chains and resubmit it")
+    p.add_option("--max-retries", dest="max_retries", type="int", metavar="N",
+                 default=3,
+                 help="with --repair, resubmit each chain at most N times [%default]")
+    p.add_option("--interval", dest="interval", type="float", metavar="SECONDS",
+                 default=0,
+                 help="with --monitor, keep checking every SECONDS; 0 checks once [%default]")
  
     opts,args = p.parse_args()
-    if len(args) == 0:
+    if opts.monitor:
+        if opts.record:
+            record = read_record(opts.record)
+            queuing_system = record['queuing_system']
+        elif args:
+            if opts.repair:
+                p.error("--repair needs the submission record (--record FILE)")
+            queuing_system = detect_queuing_system() or DEFAULT_QUEUING_SYSTEM
+            record = {'queuing_system': queuing_system, 'chains': [{'args': [], 'jobids': args}]}
+        else:
+            p.error("--monitor needs --record FILE or job ids")
+        known = {}
+        while True:
+            broken = monitor_chains(record, queuing_system, repair=opts.repair,
+                                    max_retries=opts.max_retries, known=known)
+            if opts.repair:
+                with open(opts.record, "w") as f:
+                    json.dump(record, f, indent=2)
+            if not opts.interval:
+                break
+            time.sleep(opts.interval)
+        raise SystemExit(1 if broken and not opts.repair else 0)
+    if opts.chains:
+        if opts.jobid:
+            p.error("--append cannot be used together with --chains")
+        chains = read_chains(opts.chains, common_args=args)
+        if len(chains) == 0:
+            raise ValueError('No chains were found in %r.' % opts.chains)
+    elif len(args) == 0:
         raise ValueError('No queuing script was provided.')
  
     if opts.performance and opts.walltime and opts.runtime:
@@ -176,12 +575,42 @@ if __name__ == "__main__":
         queuing_system = DEFAULT_QUEUING_SYSTEM
         print("WW Could not determine queuing system, choosing the default")
     print("-- Using submission syntax for queuing system %r" % queuing_system)
+
+    if opts.chains:
+        print("-- Submitting %d chains (at most %d at a time)" % (len(chains), opts.max_concurrent))
+        # the asyncio engine only exists for Python 3
+        from qsub_chains import qsub_chains
+        start = time.time()
+        results = qsub_chains(chains, num_jobs, queuing_system=queuing_system,
+                              max_concurrent=opts.max_concurrent, rate=opts.rate)
+        elapsed = time.time() - start
+        failed = 0
+        submitted = 0
+        for args, result in zip(chains, results):
+            if isinstance(result, Exception):
+                failed += 1
+                submitted += len(getattr(result, 'jobids', []))
+                print("EE chain %r failed: %s" % (" ".join(args), result))
+            else:
+                submitted += len(result)
+        print("-- launched %d jobs in %d chains (%d chains failed) in %.1f s"
+              % (submitted, len(chains) - failed, failed, elapsed))
+        if opts.record:
+            write_record(opts.record, chains,
+                         [getattr(r, 'jobids', []) if isinstance(r, Exception) else r
+                          for r in results], queuing_system, submitted=start)
+        raise SystemExit(1 if failed else 0)
  
     # launch the first job (if options.jobid is not None then it will depend on jobid)
+    start = time.time()
     jobid = qsub_dependents(args, jobid=opts.jobid, queuing_system=queuing_system)
+    jobids = [jobid]
  
     # all further jobs
     for ijob in range(1, int(num_jobs)):
         jobid = qsub_dependents(args, jobid=jobid, queuing_system=queuing_system)
+        jobids.append(jobid)
  
     print("-- launched %d jobs" % num_jobs)
+    if opts.record:
+        write_record(opts.record, [args], [jobids], queuing_system, submitted=start)
@@ -3,15 +3,112 @@
 # Placed into the Public Domain
 from __future__ import print_function
 
+import os
+import re
+import pwd
 import sys
+import time
+import signal
+import struct
 import subprocess
 import socket
+import distutils.spawn
 
 DEFAULTS = {'queuename': ["workstations.q"],
             'machine': socket.getfqdn(),
             'deltatime': 4,
+            'interval': 30,
+            'load_high': 1.0,
+            'load_low': 0.5,
+            'active_time': 60,
+            'idle_time': 600,
             }
 
+# jobs in the semaphore queue are tracked by semaphore.py on each host (run
+# through ssh for other hosts), which lends the resources of suspended jobs
+# to short-lived borrowers
+SEMAPHORE_QUEUE = "workstations.q"
+SEMAPHORE = "semaphore.py"
+# exit status of 'semaphore.py resume' while borrowers are still running
+SEMAPHORE_BORROWERS = 3
+# never prompt, and give up on unreachable hosts
+SSH = ["ssh", "-n", "-o", "BatchMode=yes", "-o", "ConnectTimeout=10"]
+
+# glibc struct utmp on Linux (see utmp(5)); ut_type USER_PROCESS == 7
+UTMP_FILE = "/var/run/utmp"
+UTMP_STRUCT = struct.Struct("<h2xi32s4s32s256shhiii4i20x")
+USER_PROCESS = 7
+
+def semaphore_commands(instances, action):
+    """Return ``(command, instance)`` for every instance the semaphore tracks.
+
+    Each host with an instance of the semaphore queue among *instances*
+    keeps its own semaphore; it is run directly on this host and through
+    ssh on other hosts. Host groups (``queue@@group``) have to be expanded
+    into their instances first, e.g. with :meth:`GEqueues.states`.
+    """
+    local = socket.gethostname().split(".")[0]
+    commands = []
+    for name in instances:
+        queue, _, host = name.partition("@")
+        if queue != SEMAPHORE_QUEUE or not host or host.startswith("@"):
+            continue
+        if host.split(".")[0] == local:
+            # the full path also works for 'at' jobs, which run with a
+            # different PATH
+            semaphore = distutils.spawn.find_executable(SEMAPHORE)
+            if semaphore is None:
+                print("WARNING: {0} not found on PATH, cannot {1} the semaphore "
+                      "of queue {2}".format(SEMAPHORE, action, name))
+                continue
+            cmd = [os.path.abspath(semaphore), action]
+        else:
+            cmd = SSH + [host, SEMAPHORE, action]
+        commands.append((cmd, name))
+    return commands
+
+def notify_semaphore(instances, action):
+    """Run ``semaphore.py suspend|resume`` for *instances*, all hosts at once.
+
+    Returns the list of instances whose semaphore reported borrowers that
+    are still running ('resume' only); these must not be unsuspended. Any
+    other failure (no semaphore on the host, ssh refused, ...) is reported
+    but does not keep a queue suspended.
+    """
+    procs = []
+    for cmd, name in semaphore_commands(instances, action):
+        try:
+            procs.append((subprocess.Popen(cmd), name))
+        except OSError as err:
+            print("WARNING: semaphore {0} failed for queue {1}: {2}".format(action, name, err))
+    blocked = []
+    for p, name in procs:
+        rc = p.wait()
+        if action == "resume" and rc == SEMAPHORE_BORROWERS:
+            print("ERROR: borrowers of queue {0} are still running".format(name))
+            blocked.append(name)
+        elif rc != 0:
+            print("WARNING: semaphore {0} failed for queue {1} (exit status {2})".format(
+                action, name, rc))
+    return blocked
+
+def unsuspend_script(instances):
+    """Shell commands that unsuspend *instances* (for 'at').
+
+    Borrowers of the semaphore are revoked before the queue resumes; an
+    instance stays suspended only if its borrowers are still running.
+    """
+    lines = []
+    tracked = []
+    for cmd, name in semaphore_commands(instances, "resume"):
+        lines.append("{0}; [ $? -ne {1} ] && qmod -us {2}".format(
+            " ".join(cmd), SEMAPHORE_BORROWERS, name))
+        tracked.append(name)
+    rest = [name for name in instances if name not in tracked]
+    if rest:
+        lines.append("qmod -us {0}".format(" ".join(rest)))
+    return "\n".join(lines)
+
 class GEqueue(object):
     def __init__(self, name):
         self.name = name
@@ -23,8 +120,12 @@ class GEqueue(object):
         return cmd.returncode == 0
     def suspend(self):
         rc = subprocess.call(["qmod", "-s", self.name])
+        if rc == 0:
+            notify_semaphore([self.name], "suspend")
         return rc == 0
     def unsuspend(self):
+        if notify_semaphore([self.name], "resume"):
+            return False
         rc = subprocess.call(["qmod", "-us", self.name])
         return rc == 0
     def schedule_unsuspend(self, time="21:00"):
@@ -34,21 +135,286 @@ class GEqueue(object):
         or 'today 9pm'.
         """
         cmd = subprocess.Popen(["at",  str(time)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = cmd.communicate("qmod -us {0}".format(self.name))
+        out, err = cmd.communicate(unsuspend_script([self.name]).encode("utf8"))
+        # at reports "job 42 at ..." on stderr; remember it for cancelling
+        m = re.search(r"job (\d+)", err.decode("utf8"))
+        self.atjob = m.group(1) if m else None
+        return cmd.returncode
+    def cancel_scheduled_unsuspend(self):
+        """Remove the 'at' job created by :meth:`schedule_unsuspend`."""
+        atjob = getattr(self, "atjob", None)
+        self.atjob = None
+        if atjob is None:
+            return True
+        return subprocess.call(["atrm", atjob]) == 0
+    def used_slots(self):
+        """Return the number of slots occupied by jobs in the queue instance."""
+        cmd = subprocess.Popen(["qstat", "-f", "-q", self.name], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = cmd.communicate()
+        return sum(int(fields[2].split("/")[1])
+                   for fields in _qstat_f_instances(out.decode("utf8")))
+
+def _qstat_f_instances(text):
+    """Yield the fields of every queue instance line in ``qstat -f`` output."""
+    for line in text.splitlines():
+        # job lines are indented, separators start with '-' or '#'
+        if not line or line[0] in " \t-#":
+            continue
+        fields = line.split()
+        if "@" in fields[0]:
+            yield fields
+
+def parse_qstat_f(text):
+    """Return a dict mapping queue instances to their state string.
+
+    *text* is the output of ``qstat -f``; queue instances without any
+    state flags map to the empty string.
+    """
+    return dict((fields[0], fields[5] if len(fields) > 5 else "")
+                for fields in _qstat_f_instances(text))
+
+class GEqueues(object):
+    """Several queue instances that are queried and modified together.
+
+    *names* are queue instance specifications as understood by
+    Gridengine, e.g. ``workstations.q@host1`` or, for all hosts in the
+    host group ``@lab``, ``workstations.q@@lab``.
+    """
+    def __init__(self, names):
+        self.names = list(names)
+    def states(self):
+        """Return a dict mapping every matching queue instance to its states.
+
+        All instances are fetched with a single ``qstat -f`` call.
+        """
+        cmd = subprocess.Popen(["qstat", "-f", "-q", ",".join(self.names)],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = cmd.communicate()
+        if cmd.returncode != 0:
+            raise OSError(cmd.returncode, "qstat -f failed: {0}".format(err.decode("utf8").strip()))
+        return parse_qstat_f(out.decode("utf8"))
+    def suspended(self):
+        """Return the list of queue instances in the s(uspended) state."""
+        return [name for name, states in sorted(self.states().items()) if "s" in states]
+    def suspend(self, instances):
+        """Suspend *instances* with a single qmod call.
+
+        The semaphore is not notified here because qmod may fail for some
+        of the instances; notify it for those that are verified suspended.
+        """
+        rc = subprocess.call(["qmod", "-s"] + list(instances))
+        return rc == 0
+    def unsuspend(self, instances):
+        """Unsuspend *instances* whose semaphore borrowers could be revoked."""
+        blocked = notify_semaphore(instances, "resume")
+        instances = [name for name in instances if name not in blocked]
+        if not instances:
+            return False
+        rc = subprocess.call(["qmod", "-us"] + instances)
+        return rc == 0 and not blocked
+    def schedule_unsuspend(self, instances, time="21:00"):
+        """Run a single 'at' job at *time* that unsuspends all *instances*.
+
+        *time* should be a time string understood by at, e.g., 'now +1 h'
+        or 'today 9pm'.
+        """
+        cmd = subprocess.Popen(["at",  str(time)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = cmd.communicate(unsuspend_script(instances).encode("utf8"))
         return cmd.returncode
 
+def loadavg(filename="/proc/loadavg"):
+    """Return the 1-minute load average."""
+    with open(filename) as f:
+        return float(f.read().split()[0])
+
+def user_sessions(filename=UTMP_FILE):
+    """Return ``(line, user)`` of all logged-in user sessions from utmp.
+
+    X sessions show up with their display (e.g. ':0') as the line.
+    """
+    lines = []
+    with open(filename, "rb") as f:
+        while True:
+            data = f.read(UTMP_STRUCT.size)
+            if len(data) < UTMP_STRUCT.size:
+                break
+            record = UTMP_STRUCT.unpack(data)
+            if record[0] == USER_PROCESS:
+                lines.append(tuple(field.split(b"\0", 1)[0].decode("utf8", "replace")
+                                   for field in (record[2], record[4])))
+    return lines
+
+def x_authority(display, user=None, procdir="/proc"):
+    """Return the X authority file that grants access to *display*.
+
+    The daemon runs as root, not as the user sitting at the display, so
+    the cookie is taken from the ``-auth`` argument of the X server or,
+    failing that, from the ``~/.Xauthority`` of *user*.
+    """
+    for pid in os.listdir(procdir):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(os.path.join(procdir, pid, "cmdline"), "rb") as f:
+                args = f.read().decode("utf8", "replace").split("\0")
+        except (IOError, OSError):
+            continue
+        if display in args and "-auth" in args[:-1]:
+            return args[args.index("-auth") + 1]
+    if user:
+        try:
+            path = os.path.join(pwd.getpwnam(user).pw_dir, ".Xauthority")
+        except KeyError:
+            return None
+        if os.path.exists(path):
+            return path
+    return None
+
+def session_idle(line, user=None, now=None, devdir="/dev"):
+    """Return seconds since the last input on session *line* or ``None``.
+
+    Terminal sessions use the access time of their tty (like w(1)). For X
+    displays the idle time is taken from ``xprintidle`` (with the X
+    authority of the display, see :func:`x_authority`) if it is
+    installed; otherwise it is unknown and ``None`` is returned.
+    """
+    now = time.time() if now is None else now
+    if line.startswith(":"):
+        if not distutils.spawn.find_executable("xprintidle"):
+            return None
+        env = dict(os.environ, DISPLAY=line)
+        xauthority = x_authority(line, user)
+        if xauthority:
+            env["XAUTHORITY"] = xauthority
+        cmd = subprocess.Popen(["xprintidle"], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = cmd.communicate()
+        if cmd.returncode != 0:
+            return None
+        return int(out) / 1000.
+    try:
+        return max(0., now - os.stat(os.path.join(devdir, line)).st_atime)
+    except OSError:
+        return None
+
+class LoadWatcher(object):
+    """Decide from local signals whether the workstation is in interactive use.
+
+    The workstation is *busy* when input was seen within *active_time*
+    seconds or the interactive load (load average minus the load of queue
+    jobs) reaches *load_high*. It is *idle* when no session had input for
+    *idle_time* seconds and the interactive load is at most *load_low*.
+    In between, the previous decision is kept (hysteresis).
+    """
+    def __init__(self, load_high=DEFAULTS['load_high'], load_low=DEFAULTS['load_low'],
+                 active_time=DEFAULTS['active_time'], idle_time=DEFAULTS['idle_time'],
+                 loadavg_file="/proc/loadavg", utmp_file=UTMP_FILE):
+        self.load_high = load_high
+        self.load_low = load_low
+        self.active_time = active_time
+        self.idle_time = idle_time
+        self.loadavg_file = loadavg_file
+        self.utmp_file = utmp_file
+        self.busy = False
+    def input_idle(self):
+        """Return the shortest idle time of all sessions (``None`` if unknown)."""
+        try:
+            sessions = user_sessions(self.utmp_file)
+        except (IOError, OSError):
+            return None
+        idle = [t for t in (session_idle(line, user) for line, user in sessions)
+                if t is not None]
+        return min(idle) if idle else None
+    def update(self, job_load=0):
+        """Sample the signals and return ``True`` if the workstation is busy.
+
+        *job_load* is the load caused by running queue jobs (one per
+        occupied slot); it is subtracted from the load average.
+        """
+        load = max(0., loadavg(self.loadavg_file) - job_load)
+        idle = self.input_idle()
+        if (idle is not None and idle < self.active_time) or load >= self.load_high:
+            self.busy = True
+        elif (idle is None or idle >= self.idle_time) and load <= self.load_low:
+            self.busy = False
+        return self.busy
+
+class QueueDaemon(object):
+    """Suspend a :class:`GEqueue` while the workstation is in interactive use.
+
+    The queue is unsuspended as soon as the :class:`LoadWatcher` reports
+    the workstation idle, but at the latest after *maxtime* hours. After
+    hitting that cap the queue is only suspended again once the
+    workstation was idle in between. Queues that were suspended by
+    somebody else are left alone.
+
+    Every suspension is backed by an 'at' job that unsuspends the queue
+    after *maxtime* hours, so the cap also holds if the daemon dies.
+    """
+    def __init__(self, queue, watcher, maxtime=DEFAULTS['deltatime']):
+        self.queue = queue
+        self.watcher = watcher
+        self.maxtime = maxtime
+        self.suspended_at = None
+        self.capped = False
+    def step(self, now=None):
+        """Sample the workstation once and suspend/unsuspend the queue."""
+        now = time.time() if now is None else now
+        suspended = self.suspended_at is not None
+        # stopped jobs do not contribute to the load average
+        job_load = 0 if suspended else self.queue.used_slots()
+        busy = self.watcher.update(job_load=job_load)
+        if not busy:
+            self.capped = False
+        if suspended:
+            if not busy:
+                if self.unsuspend():
+                    print("Workstation idle: unsuspended queue {0}".format(self.queue.name))
+            elif now - self.suspended_at >= self.maxtime * 3600:
+                if self.unsuspend():
+                    print("Maximum suspend time of {0} hours reached: unsuspended queue {1}".format(
+                        self.maxtime, self.queue.name))
+                    self.capped = True
+        elif busy and not self.capped and not self.queue.issuspended():
+            if self.queue.suspend():
+                print("Workstation in use: suspended queue {0}".format(self.queue.name))
+                self.suspended_at = now
+                minutes = int(self.maxtime * 60)
+                self.queue.schedule_unsuspend(time="now + {0} min".format(minutes))
+    def unsuspend(self):
+        """Unsuspend the queue and drop the pending 'at' job."""
+        if not self.queue.unsuspend():
+            return False
+        self.queue.cancel_scheduled_unsuspend()
+        self.suspended_at = None
+        return True
+    def run(self, interval=DEFAULTS['interval']):
+        def terminate(signum, frame):
+            raise SystemExit(0)
+        handler = signal.signal(signal.SIGTERM, terminate)
+        try:
+            while True:
+                self.step()
+                sys.stdout.flush()
+                time.sleep(interval)
+        finally:
+            signal.signal(signal.SIGTERM, handler)
+            # never leave the queue suspended when the daemon goes away
+            if self.suspended_at is not None and self.unsuspend():
+                print("Unsuspended queue {0}".format(self.queue.name))
+
 if __name__ == "__main__":
     import argparse
-    parser = argparse.ArgumentParser(description="Suspend the queue on HOSTNAME or MACHINE "
+    parser = argparse.ArgumentParser(description="Suspend the queue on HOSTNAME or on one or more MACHINEs "
                                      "until TIME h have passed or until you run "
                                      "qsuspend again. "
                                      "Note that the executing user has to be a Gridengine "
                                      "admin or the script must be run through 'sudo'. "
                                      "If you cannot run it, talk to a sysadmin.",
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument("machine", metavar="MACHINE", nargs="?",
-                        default=DEFAULTS['machine'],
-                        help="Fully qualified hostname where the queue QUEUENAME should be suspended")
+    parser.add_argument("machine", metavar="MACHINE", nargs="*",
+                        default=[DEFAULTS['machine']],
+                        help="Fully qualified hostname(s) where the queue QUEUENAME should be "
+                        "suspended; a Gridengine host group such as @lab selects all its hosts")
     parser.add_argument("-q", "--queue-name", metavar="QUEUENAME", nargs='*', dest="queuename",
                         default=DEFAULTS['queuename'],
                         help="Name of the Gridengine queue instance.")
@@ -56,6 +422,30 @@ if __name__ == "__main__":
                         default=DEFAULTS['deltatime'],
                         help="Suspended queues are automatically unsuspended after that many hours. "
                         "The maximum allowed value is 8 (hours).")
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument("-s", "--suspend", action="store_const", const="suspend", dest="action",
+                        help="Suspend all selected queue instances instead of toggling their state.")
+    action.add_argument("-u", "--unsuspend", action="store_const", const="unsuspend", dest="action",
+                        help="Unsuspend all selected queue instances instead of toggling their state.")
+    action.add_argument("-d", "--daemon", action="store_const", const="daemon", dest="action",
+                        help="Keep running and automatically suspend the queue on this machine while "
+                        "the workstation is in interactive use; TIME is the longest suspension.")
+    parser.add_argument("--interval", metavar="SECONDS", type=float,
+                        default=DEFAULTS['interval'],
+                        help="Daemon mode: time between checks of the workstation.")
+    parser.add_argument("--load-high", metavar="LOAD", type=float, dest="load_high",
+                        default=DEFAULTS['load_high'],
+                        help="Daemon mode: suspend when the load not caused by queue jobs reaches LOAD.")
+    parser.add_argument("--load-low", metavar="LOAD", type=float, dest="load_low",
+                        default=DEFAULTS['load_low'],
+                        help="Daemon mode: the load not caused by queue jobs must drop to LOAD "
+                        "before the queue is unsuspended.")
+    parser.add_argument("--active-time", metavar="SECONDS", type=float, dest="active_time",
+                        default=DEFAULTS['active_time'],
+                        help="Daemon mode: suspend when a user session had input within SECONDS.")
+    parser.add_argument("--idle-time", metavar="SECONDS", type=float, dest="idle_time",
+                        default=DEFAULTS['idle_time'],
+                        help="Daemon mode: unsuspend when no user session had input for SECONDS.")
 
     args = parser.parse_args()
 
@@ -67,19 +457,73 @@ if __name__ == "__main__":
         print("ERROR: Suspend time must be >= 0")
         sys.exit(1)
 
-    for queue in args.queuename:
-        queuename = queue+"@"+args.machine    
-        q = GEqueue(queuename)
-
-        if not q.issuspended():
-            # suspend
-            success = q.suspend()
-            if success:
-                print("Suspended queue {0}".format(queuename))
-                minutes = int(args.time * 60)
-                q.schedule_unsuspend(time="now + {0} min".format(minutes))
-                print("Will automatically unsuspend the queue after {0} hours".format(args.time))
+    if args.action == "daemon":
+        if args.load_low > args.load_high or args.idle_time < args.active_time:
+            print("ERROR: Thresholds must satisfy --load-low <= --load-high and "
+                  "--active-time <= --idle-time")
+            sys.exit(1)
+        if len(args.queuename) != 1 or len(args.machine) != 1:
+            print("ERROR: Daemon mode watches exactly one queue on the local machine")
+            sys.exit(1)
+        watcher = LoadWatcher(load_high=args.load_high, load_low=args.load_low,
+                              active_time=args.active_time, idle_time=args.idle_time)
+        daemon = QueueDaemon(GEqueue(args.queuename[0] + "@" + args.machine[0]),
+                             watcher, maxtime=args.time)
+        print("Watching queue {0} (checking every {1} s)".format(daemon.queue.name, args.interval))
+        try:
+            daemon.run(interval=args.interval)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    names = [queue + "@" + machine for queue in args.queuename for machine in args.machine]
+    queues = GEqueues(names)
+
+    # one query for the state of every queue instance
+    try:
+        states = queues.states()
+    except OSError as err:
+        print("ERROR: {0}".format(err))
+        sys.exit(1)
+    if not states:
+        print("ERROR: No queue instances matching {0}".format(" ".join(names)))
+        sys.exit(1)
+
+    running = sorted(name for name in states if "s" not in states[name])
+    suspended = sorted(name for name in states if "s" in states[name])
+    if args.action == "suspend":
+        suspended = []
+    elif args.action == "unsuspend":
+        running = []
+
+    if running:
+        queues.suspend(running)
+    if suspended:
+        queues.unsuspend(suspended)
+
+    # check the outcome for every instance
+    now_suspended = set(queues.suspended())
+    failed = 0
+    for name in running:
+        if name in now_suspended:
+            print("Suspended queue {0}".format(name))
+        else:
+            print("ERROR: Failed to suspend queue {0}".format(name))
+            failed += 1
+    for name in suspended:
+        if name not in now_suspended:
+            print("Unsuspended queue {0}".format(name))
         else:
-            success = q.unsuspend()
-            if success:
-                print("Unsuspended queue {0}".format(queuename))
+            print("ERROR: Failed to unsuspend queue {0}".format(name))
+            failed += 1
+
+    newly_suspended = [name for name in running if name in now_suspended]
+    notify_semaphore(newly_suspended, "suspend")
+    if newly_suspended:
+        minutes = int(args.time * 60)
+        queues.schedule_unsuspend(newly_suspended, time="now + {0} min".format(minutes))
+        print("Will automatically unsuspend {0} queue(s) after {1} hours".format(
+            len(newly_suspended), args.time))
+
+    if failed:
+        sys.exit(1)
@@ -13,6 +13,53 @@ Subcommands:
         get job resources as an mdrun input string
     *clear*
         clear resources in use by the given job id
+    *suspend*
+        mark jobs as suspended so that their resources can be lent
+    *resume*
+        revoke borrowers of suspended jobs and unmark them; exits with
+        status 3 if borrowers are still running, then the jobs must
+        not be resumed yet
+    *borrow*
+        claim resources of suspended jobs for a short-lived job
+    *history*
+        report utilization, refusals, job sizes and time-to-start
+
+Claims have a priority class (low, normal, high). A request with
+--preempt may take resources of lower-priority jobs; how depends on
+SEMAPHORE_PREEMPT_MODE:
+
+    *suspend* (default)
+        the jobs are stopped with SEMAPHORE_PREEMPT_HOOK (default
+        'qmod -sj {jobid}') and resumed, through SEMAPHORE_RESUME_HOOK
+        (default 'qmod -usj {jobid}'), once the preempting job is gone.
+        A suspended job still holds its memory and gpu memory, so only
+        its cores can be taken; the rest stays reserved for it.
+    *exit*
+        the jobs are made to checkpoint and leave the host with
+        SEMAPHORE_PREEMPT_HOOK (default 'qmod -rj {jobid}', which
+        requeues them); all their resources can be taken and are
+        released once the jobs are gone.
+
+If the hook fails or the jobs are still running after the timeout, the
+preemption is undone and the request fails.
+
+If the environment variable SEMAPHORE_CGROUP_ROOT is set (e.g. to
+/sys/fs/cgroup), claims are enforced: every job gets a cgroup v2 cpuset
+with its claimed cores below that root. If SEMAPHORE_DEVICES_ROOT names
+a cgroup v1 devices hierarchy (e.g. /sys/fs/cgroup/devices), jobs can
+only open their claimed nvidia gpus as well. cgroup v2 filters devices
+only through eBPF programs, which are not set up here, so on hosts
+without a v1 devices hierarchy gpus are not enforced.
+
+Moving the job's processes into its cgroup needs root, or a delegated
+subtree with write access to cgroup.procs of the common ancestor of
+the job's current cgroup and SEMAPHORE_CGROUP_ROOT; otherwise every
+request fails and its claim is given up.
+
+Gpu ids are the indices reported by nvidia-smi, which numbers gpus in
+PCI bus order. CUDA orders them fastest first by default, so jobs must
+run with CUDA_DEVICE_ORDER=PCI_BUS_ID for the ids (e.g. in the gmxify
+string) to refer to the same devices.
 
 """
 import argparse
@@ -24,8 +71,203 @@ from functools import wraps
 import os
 import sys
 import re
+import time
+import zlib
+import errno
+import shlex
+import struct
+import itertools
 import py
 
+# priority classes of claims
+PRIORITIES = {'low': 0, 'normal': 1, 'high': 2}
+
+# exit status of 'resume' while borrowers of the jobs are still running
+EXIT_BORROWERS = 3
+
+class History(object):
+    """Fixed-size ring buffer of semaphore events in a binary file.
+
+    Every record has the same size, so appending is a single seek and
+    write; once *capacity* records have been written the oldest ones are
+    overwritten. The file is not locked itself; appends must happen while
+    the semaphore holds its exclusive lock.
+
+    """
+    MAGIC = b'SEMH'
+    HEADER = struct.Struct('<4sIQ')
+    RECORD = struct.Struct('<dIBBBBHH')
+    # numpy equivalent of RECORD
+    DTYPE = [('time', '<f8'), ('job', '<u4'), ('event', 'u1'),
+             ('pinstride', 'u1'), ('ngpus', 'u1'), ('gpus_used', 'u1'),
+             ('ncores', '<u2'), ('cores_used', '<u2')]
+
+    CLAIM = 1
+    CLEAR = 2
+    REFUSE = 3
+
+    def __init__(self, filename, capacity=2**20):
+        """Create History instance for the ledger file *filename*.
+
+        :Arguments:
+            *filename*
+                name of ledger file on disk
+            *capacity*
+                maximum number of records kept; only used when the file
+                is created
+
+        """
+        self.filename = os.path.abspath(filename)
+        self.capacity = capacity
+
+    def _open(self):
+        try:
+            f = open(self.filename, 'r+b')
+        except IOError:
+            f = open(self.filename, 'w+b')
+            f.write(self.HEADER.pack(self.MAGIC, self.capacity, 0))
+            # set permissions if you can
+            try:
+                py.path.local(self.filename).chmod(0o777)
+            except py.error.EPERM:
+                pass
+            f.seek(0)
+        return self._header(f)
+
+    def _open_r(self):
+        return self._header(open(self.filename, 'rb'))
+
+    def _header(self, f):
+        magic, capacity, count = self.HEADER.unpack(f.read(self.HEADER.size))
+        if magic != self.MAGIC:
+            f.close()
+            raise IOError("'{}' is not a semaphore history".format(self.filename))
+        return f, capacity, count
+
+    @staticmethod
+    def jobkey(jobid):
+        """Numeric key for *jobid*: the job number or a crc32 of the id."""
+        try:
+            return int(jobid) & 0xffffffff
+        except ValueError:
+            return zlib.crc32(str(jobid).encode('utf8')) & 0xffffffff
+
+    def append(self, event, jobid, ncores, ngpus, pinstride,
+               cores_used, gpus_used, now=None):
+        """Append one event to the ledger.
+
+        :Arguments:
+            *event*
+                one of :attr:`CLAIM`, :attr:`CLEAR` or :attr:`REFUSE`
+            *jobid*
+                unique id of job the event concerns
+            *ncores*, *ngpus*, *pinstride*
+                resources claimed, released or refused
+            *cores_used*, *gpus_used*
+                number of cores and gpus in use after the event
+        """
+        now = time.time() if now is None else now
+        f, capacity, count = self._open()
+        try:
+            f.seek(self.HEADER.size + (count % capacity) * self.RECORD.size)
+            f.write(self.RECORD.pack(now, self.jobkey(jobid), event,
+                                     min(pinstride, 255), min(ngpus, 255),
+                                     min(gpus_used, 255), ncores, cores_used))
+            f.seek(0)
+            f.write(self.HEADER.pack(self.MAGIC, capacity, count + 1))
+        finally:
+            f.close()
+
+    def read(self):
+        """Get all records in chronological order.
+
+        :Returns:
+            *data*
+                raw bytes of the records, each :attr:`RECORD` long
+        """
+        try:
+            f, capacity, count = self._open_r()
+        except IOError:
+            return b''
+        try:
+            data = f.read(min(count, capacity) * self.RECORD.size)
+        finally:
+            f.close()
+        if count <= capacity:
+            return data
+        # oldest record sits where the next one would be written
+        split = (count % capacity) * self.RECORD.size
+        return data[split:] + data[:split]
+
+    def records(self):
+        """Get all records as a numpy structured array (oldest first)."""
+        import numpy as np
+        return np.frombuffer(self.read(), dtype=np.dtype(self.DTYPE))
+
+
+def history_report(records, ncore, ngpu, start, stop, nbins=24):
+    """Summarize semaphore history *records* between *start* and *stop*.
+
+    :Arguments:
+        *records*
+            structured array as returned by :meth:`History.records`
+        *ncore*, *ngpu*
+            number of cores and gpus available to the queue
+        *start*, *stop*
+            time window (seconds since the epoch)
+        *nbins*
+            number of intervals for the utilization time series
+
+    :Returns:
+        *report*
+            dict with the bin edges ``time``, the mean fraction of cores and
+            gpus in use per bin (``cores``, ``gpus``), the event counts
+            ``claims``, ``clears`` and ``refusals``, the ``refusal_rate``
+            and the distributions ``sizes`` (``(ncores, ngpus)`` of claims)
+            and ``pinstrides`` as dicts of counts
+    """
+    import numpy as np
+
+    edges = np.linspace(start, stop, nbins + 1)
+    t = records['time']
+
+    def occupancy(values, total):
+        # occupancy is a step function that changes at every event;
+        # integrate it exactly over each bin
+        if len(t) == 0 or total == 0:
+            return np.zeros(nbins)
+        v = values.astype(float)
+        cum = np.concatenate(([0.], np.cumsum(v[:-1] * np.diff(t))))
+        k = np.searchsorted(t, edges, side='right') - 1
+        known = k >= 0
+        kk = np.where(known, k, 0)
+        # nothing is known to be in use before the first event
+        F = np.where(known, cum[kk] + v[kk] * (edges - t[kk]), 0.)
+        return np.diff(F) / np.diff(edges) / total
+
+    window = records[(t >= start) & (t < stop)]
+    claims = window[window['event'] == History.CLAIM]
+    nclaims = len(claims)
+    nrefusals = int(np.count_nonzero(window['event'] == History.REFUSE))
+    nrequests = nclaims + nrefusals
+
+    sizes, counts = np.unique(
+        np.stack([claims['ncores'], claims['ngpus']], axis=1), axis=0,
+        return_counts=True) if nclaims else ([], [])
+    strides, scounts = np.unique(claims['pinstride'], return_counts=True)
+
+    return dict(
+        time=edges,
+        cores=occupancy(records['cores_used'], ncore),
+        gpus=occupancy(records['gpus_used'], ngpu),
+        claims=nclaims,
+        clears=int(np.count_nonzero(window['event'] == History.CLEAR)),
+        refusals=nrefusals,
+        refusal_rate=float(nrefusals) / nrequests if nrequests else 0.,
+        sizes=dict(((int(c), int(g)), int(n)) for (c, g), n in zip(sizes, counts)),
+        pinstrides=dict((int(p), int(n)) for p, n in zip(strides, scounts)),
+        )
+
 class File(object):
     """File object base class. Implements file locking and reloading methods.
 
@@ -44,6 +286,9 @@ class File(object):
         self.fd = None
         self.fdlock = None
 
+        # ledger of claims, clears and refusals next to the state file
+        self.history = History(os.path.splitext(self.filename)[0] + '.history')
+
         # we apply locks to a proxy file to avoid creating an HDF5 file
         # without an exclusive lock on something; important for multiprocessing
         proxy = "." + os.path.basename(self.filename) + ".proxy"
@@ -250,6 +495,35 @@ class File(object):
             return out
         return inner
 
+    def _log_refusal(func):
+        """Decorator recording refused requests in the history ledger and
+        the time a job was first refused in the record."""
+        @wraps(func)
+        def inner(self, jobid, ncores, ngpus, *args, **kwargs):
+            try:
+                return func(self, jobid, ncores, ngpus, *args, **kwargs)
+            except ValueError:
+                self._log(History.REFUSE, jobid, ncores, ngpus,
+                          kwargs.get('pinstride', 0))
+                # remember when the job first asked (for time-to-start);
+                # the record is not pushed for a failed request otherwise
+                waiting = self._record.setdefault('waiting', dict())
+                if jobid not in waiting:
+                    now = kwargs.get('now')
+                    waiting[jobid] = time.time() if now is None else now
+                    self._push_record()
+                raise
+        return inner
+
+    def _log(self, event, jobid, ncores, ngpus, pinstride):
+        """Append an event to the history ledger; never fails the caller."""
+        used = self._used()
+        try:
+            self.history.append(event, jobid, ncores, ngpus, pinstride,
+                                len(set(used['cores'])), len(set(used['gpus'])))
+        except (IOError, OSError) as err:
+            print('could not write to history: {}'.format(err))
+
     def _pull_record(self):
         self.handle = self._open_file_r()
         self._record = yaml.load(self.handle)
@@ -264,10 +538,13 @@ class File(object):
         self._record = dict()
         self._record['resource'] = dict()
         self._record['jobs'] = dict()
+        self._record['preempted'] = dict()
+        self._record['waiting'] = dict()
+        self._record['stats'] = dict()
 
     @_write
     @_pull_push
-    def populate(self, host, ncore, totcore, ngpu):
+    def populate(self, host, ncore, totcore, ngpu, mem=None, gpumem=None):
         """Build status file elements.
 
         :Keywords:
@@ -279,17 +556,35 @@ class File(object):
                 total number of cores on machine (including hyperthreads)
             *ngpu*
                 total number of gpus available to queue
+            *mem*
+                host memory available to queue in MB; ``None`` if unknown
+            *gpumem*
+                list giving the memory of each gpu in MB, indexed by gpu
+                id; ``None`` if unknown, and entries may be ``None`` for
+                gpus whose memory is unknown
         """
         self._record['resource']['host'] = host
         self._record['resource']['ncore'] = ncore
         self._record['resource']['totcore'] = totcore
         self._record['resource']['ngpu'] = ngpu
+        self._record['resource']['mem'] = mem
+        self._record['resource']['gpumem'] = gpumem
 
     @_write
     @_pull_push
-    def request(self, jobid, ncores, ngpus, pinstride=2):
+    @_log_refusal
+    def request(self, jobid, ncores, ngpus, pinstride=2, mem=0, gpumem=0,
+                priority=PRIORITIES['normal'], preempt=False, release=False,
+                now=None):
         """Request a number of resources for given job.
 
+        If the resources are not available and *preempt* is set, the
+        smallest set of running jobs with a lower priority whose resources
+        would satisfy the request is preempted: their claims are set
+        aside and the resources needed are claimed for this job in one
+        step. The caller has to stop the preempted jobs, or undo the
+        preemption with :meth:`unpreempt`.
+
         :Arguments:
             *jobid*
                 unique id of job claiming resources
@@ -299,13 +594,64 @@ class File(object):
                 number of gpus desired
             *pinstride*
                 minimum pinstride to match
+            *mem*
+                host memory desired in MB
+            *gpumem*
+                memory in MB each of the gpus must have
+            *priority*
+                priority class of the job, see ``PRIORITIES``
+            *preempt*
+                preempt lower-priority jobs if necessary
+            *release*
+                preempted jobs leave the host (and are cleared once they
+                are gone) instead of being suspended: all their resources
+                can be taken, not just their cores
+            *now*
+                current time (seconds since the epoch); a job that was
+                refused before keeps the time of its first request
+
+        :Returns:
+            *victims*
+                list of jobids that were preempted
         """
+        now = time.time() if now is None else now
+        try:
+            self._request(jobid, ncores, ngpus, pinstride, mem, gpumem)
+            victims = []
+        except ValueError:
+            if not preempt:
+                raise
+            victims = self._preempt(jobid, ncores, ngpus, pinstride, mem,
+                                    gpumem, priority, release)
+
+        job = self._record['jobs'][jobid]
+        job['priority'] = priority
+        job['requested'] = self._record.setdefault('waiting', dict()).pop(jobid, now)
+        if victims:
+            job['preempted'] = victims
+        return victims
+
+    def _request(self, jobid, ncores, ngpus, pinstride=2, mem=0, gpumem=0):
         if jobid in self._record['jobs']:
             raise KeyError("job '{}' already has resources".format(jobid))
 
         # get resources available
         avail = self._avail()
+        cores_claimed, gpus_claimed = self._place(avail, ncores, ngpus,
+                                                  pinstride, mem, gpumem)
+
+        self._claim(jobid, cores_claimed, gpus_claimed, mem)
+
+    def _place(self, avail, ncores, ngpus, pinstride=2, mem=0, gpumem=0):
+        """Choose cores and gpus for a request from resources *avail*.
 
+        :Returns:
+            *cores*, *gpus*
+                lists of core and gpu ids
+
+        :Raises:
+            ValueError if the request cannot be satisfied
+        """
         ncores_avail = (len(avail['cores']) -
                        (self._record['resource']['totcore'] -
                         self._record['resource']['ncore']))
@@ -313,48 +659,279 @@ class File(object):
         if (ncores_avail < ncores):
             raise ValueError("not enough cores available")
 
+        if (avail['mem'] is not None and avail['mem'] < mem):
+            raise ValueError("not enough memory available")
+
+        cores_claimed = self._find_cores(avail['cores'], ncores, pinstride)
+
+        if not cores_claimed:
+            raise ValueError("no core config matching request could be found")
+
+        # get gpu configuration
+        if (ngpus_avail < ngpus):
+            raise ValueError("not enough gpus available")
+
+        gpus_claimed = self._find_gpus(avail['gpus'], ngpus, gpumem)
+        if gpus_claimed is None:
+            raise ValueError("not enough gpus with {} MB memory available".format(gpumem))
+
+        return cores_claimed, gpus_claimed
+
+    def _preempt(self, jobid, ncores, ngpus, pinstride, mem, gpumem, priority,
+                 release=False, max_tries=10000):
+        """Set aside the fewest lower-priority jobs that make room for a request.
+
+        Candidates are running jobs with a lower priority that neither
+        borrow nor lend resources. Unless they *release* their resources
+        (by leaving the host) only their cores can be taken; suspended
+        jobs keep their memory and gpus. Sets of increasing size are
+        tried, lowest priority and smallest jobs first; after *max_tries*
+        placements the remaining candidates are added greedily in that
+        order.
+
+        :Returns:
+            *victims*
+                list of preempted jobids
+
+        :Raises:
+            ValueError if even preempting all candidates is not enough
+        """
+        jobs = self._record['jobs']
+        candidates = sorted(
+            (k for k, v in jobs.items()
+             if v.get('priority', PRIORITIES['normal']) < priority and
+             not v.get('suspended') and 'lenders' not in v),
+            key=lambda k: (jobs[k].get('priority', PRIORITIES['normal']),
+                           len(jobs[k]['cores']), len(jobs[k]['gpus'])))
+
+        def attempt(victims):
+            try:
+                if release:
+                    avail = self._avail(without=victims)
+                else:
+                    avail = self._avail(stopped=victims)
+                return self._place(avail, ncores, ngpus,
+                                   pinstride, mem, gpumem)
+            except ValueError:
+                return None
+
+        tries = 0
+        found = None
+        for k in range(1, len(candidates) + 1):
+            for victims in itertools.combinations(candidates, k):
+                tries += 1
+                placement = attempt(victims)
+                if placement is not None:
+                    found = victims, placement
+                    break
+                if tries >= max_tries:
+                    break
+            if found or tries >= max_tries:
+                break
+        if found is None and tries >= max_tries:
+            for k in range(1, len(candidates) + 1):
+                placement = attempt(candidates[:k])
+                if placement is not None:
+                    found = candidates[:k], placement
+                    break
+        if found is None:
+            raise ValueError("not enough resources, even after preempting "
+                             "lower-priority jobs")
+
+        victims, (cores, gpus) = found
+        preempted = self._record.setdefault('preempted', dict())
+        for item in victims:
+            job = jobs.pop(item)
+            job['by'] = jobid
+            if release:
+                # held until the job is gone and cleared, never restored
+                job['released'] = True
+            preempted[item] = job
+            self._log(History.CLEAR, item, len(job['cores']), len(job['gpus']), 0)
+        self._claim(jobid, cores, gpus, mem)
+        return list(victims)
+
+    @_write
+    @_pull_push
+    def unpreempt(self, jobid):
+        """Undo a preemption by *jobid*, e.g. because its victims still run.
+
+        The claim of *jobid* is cleared (it keeps the time of its first
+        request for a later attempt) and the jobs it preempted get their
+        claims back.
+
+        :Returns:
+            *restored*
+                list of jobids of preempted jobs that got their claims back
+        """
+        jobs = self._record['jobs']
+        preempted = self._record.setdefault('preempted', dict())
+        job = jobs.pop(jobid, None)
+        if job is not None:
+            self._log(History.CLEAR, jobid, len(job['cores']), len(job['gpus']), 0)
+            self._record.setdefault('waiting', dict())[jobid] = job['requested']
+
+        restored = []
+        for item in sorted(k for k, v in preempted.items() if v['by'] == jobid):
+            victim = preempted.pop(item)
+            del victim['by']
+            victim.pop('released', None)
+            jobs[item] = victim
+            restored.append(item)
+            pinstride = victim['cores'][1] - victim['cores'][0] if len(victim['cores']) > 1 else 1
+            self._log(History.CLAIM, item, len(victim['cores']), len(victim['gpus']), pinstride)
+
+        return restored
+
+    @_write
+    @_pull_push
+    def started(self, jobid, now=None):
+        """Record that a job started; updates time-to-start statistics.
+
+        The wait is counted from the first request of the job, including
+        refused ones, to now.
+
+        :Arguments:
+            *jobid*
+                unique id of job that could start running
+            *now*
+                current time (seconds since the epoch)
+
+        :Returns:
+            *wait*
+                seconds between first request and start
+        """
+        job = self._record['jobs'][jobid]
+        now = time.time() if now is None else now
+        wait = now - job.get('requested', now)
+        job['started'] = now
+
+        name = dict((v, k) for k, v in PRIORITIES.items()).get(
+            job.get('priority', PRIORITIES['normal']), 'normal')
+        stats = self._record.setdefault('stats', dict()).setdefault(
+            name, dict(count=0, wait=0., max=0.))
+        stats['count'] += 1
+        stats['wait'] += wait
+        stats['max'] = max(stats['max'], wait)
+        return wait
+
+    @_read
+    @_pull
+    def stats(self):
+        """Get time-to-start statistics per priority class.
+
+        :Returns:
+            *stats*
+                dict mapping priority class names to dicts with the number
+                of started jobs (``count``), their total and maximum wait
+                in seconds (``wait``, ``max``)
+        """
+        return self._record.get('stats', dict())
+
+    @_read
+    @_pull
+    def preempted(self):
+        """Get jobs that were preempted and wait for their resources.
+
+        :Returns:
+            *preempted*
+                dict mapping jobids to their set-aside claims; ``by`` gives
+                the job that preempted them
+        """
+        return self._record.get('preempted', dict())
+
+    @_read
+    @_pull
+    def waiting(self):
+        """Get jobs that were refused and have not got a claim yet.
+
+        :Returns:
+            *waiting*
+                dict mapping jobids to the time of their first request
+        """
+        return self._record.get('waiting', dict())
+
+    def _find_cores(self, cores, ncores, pinstride=2):
+        """Find a strided set of *ncores* cores among *cores*.
+
+        :Arguments:
+            *cores*
+                core ids that may be used
+            *ncores*
+                number of cores desired
+            *pinstride*
+                minimum pinstride to match
+
+        :Returns:
+            *candidate*
+                list of core ids, or ``None`` if no matching configuration
+                could be found
+        """
         # get core configuration
         totcores = self._record['resource']['totcore']
 
+        # represent core sets as bitmasks so that testing a candidate is a
+        # single integer operation, even on nodes with hundreds of cores
+        avail = 0
+        for core in cores:
+            avail |= 1 << core
+
         # iterate through different pinstrides
         # can only get pinstrides up to total cores/desired
-        cores_claimed = None
-        for i in range(pinstride, totcores/ncores + 1):
+        for i in range(pinstride, totcores//ncores + 1):
+            pattern = 0
+            for k in range(ncores):
+                pattern |= 1 << (k * i)
 
             # iterate through possible offsets
             for j in range(0, totcores - (i * ncores) + i, i):
-                candidate = range(j, totcores, i)[:ncores]
+                candidate = pattern << j
 
                 # grab the first candidate set of cores that satisfies
                 # available set
-                if set(avail['cores']).issuperset(set(candidate)):
-                    cores_claimed = candidate
-                    break
-
-            if cores_claimed:
-                break
+                if candidate & avail == candidate:
+                    return list(range(j, j + i * ncores, i))
 
-        if not cores_claimed:
-            raise ValueError("no core config matching request could be found")
+        return None
 
-        # get gpu configuration
-        if (ngpus_avail < ngpus):
-            raise ValueError("not enough gpus available")
+    def _find_gpus(self, gpus, ngpus, gpumem=0):
+        """Pick *ngpus* of *gpus* that have at least *gpumem* MB memory.
 
+        Of the gpus that are large enough the smallest ones are taken, so
+        that large gpus remain available for jobs that need them. Gpus of
+        unknown size never qualify.
 
-        # take first n gpus available
-        gpus_claimed = avail['gpus'][:ngpus]
-
-        self._claim(jobid, cores_claimed, gpus_claimed)
-
-    def _claim(self, jobid, cores, gpus):
+        :Returns:
+            *gpus*
+                list of gpu ids, or ``None`` if not enough gpus qualify
+        """
+        sizes = self._record['resource'].get('gpumem')
+        if not gpumem or not sizes:
+            # take first n gpus available
+            return list(gpus)[:ngpus]
+
+        fitting = []
+        for g in gpus:
+            size = sizes[g] if g < len(sizes) else None
+            if size is not None and size >= gpumem:
+                fitting.append((size, g))
+        fitting.sort()
+        if len(fitting) < ngpus:
+            return None
+        return sorted(g for size, g in fitting[:ngpus])
+
+    def _claim(self, jobid, cores, gpus, mem=0):
         self._record['jobs'][jobid] = dict()
         self._record['jobs'][jobid]['cores'] = cores
         self._record['jobs'][jobid]['gpus'] = gpus
+        self._record['jobs'][jobid]['mem'] = mem
+
+        pinstride = cores[1] - cores[0] if len(cores) > 1 else 1
+        self._log(History.CLAIM, jobid, len(cores), len(gpus), pinstride)
 
     @_write
     @_pull_push
-    def claim(self, jobid, cores, gpus):
+    def claim(self, jobid, cores, gpus, mem=0):
         """Claim resources for given job.
 
         :Arguments:
@@ -364,17 +941,31 @@ class File(object):
                 list of core ids to claim
             *gpus*
                 list of gpu ids to claim
+            *mem*
+                host memory to claim in MB
         """
-        self._claim(jobid, cores, gpus)
+        self._claim(jobid, cores, gpus, mem)
+
+    def _used(self, without=(), stopped=()):
+        """Resources held by running and preempted jobs.
 
-    def _used(self): 
+        Jobs in *without* are left out; jobs in *stopped* (about to be
+        preempted) hold only their memory and gpus.
+        """
         used = dict()
         used['cores'] = list()
         used['gpus'] = list()
-
-        for jobid in self._record['jobs']:
-            used['cores'].extend(self._record['jobs'][jobid]['cores'])
-            used['gpus'].extend(self._record['jobs'][jobid]['gpus'])
+        used['mem'] = 0
+
+        jobs = list(self._record['jobs'].items())
+        jobs.extend(self._record.get('preempted', dict()).items())
+        for jobid, job in jobs:
+            if jobid in without:
+                continue
+            if jobid not in stopped:
+                used['cores'].extend(job['cores'])
+            used['gpus'].extend(job['gpus'])
+            used['mem'] += job.get('mem', 0)
 
         return used
 
@@ -386,18 +977,21 @@ class File(object):
         :Returns:
             *resources*
                 dict giving cores in use as a list of core ids and gpus in
-                use as a list of gpu ids; both lists are 0-based
+                use as a list of gpu ids; both lists are 0-based; host
+                memory in use is given in MB
 
         """
         return self._used()
 
-    def _avail(self):
-        used = self._used()
+    def _avail(self, without=(), stopped=()):
+        used = self._used(without, stopped)
         avail = dict()
         avail['cores'] = list(set(range(self._record['resource']['totcore'])) -
                          set(used['cores']))
         avail['gpus'] = list(set(range(self._record['resource']['ngpu'])) -
                          set(used['gpus']))
+        mem = self._record['resource'].get('mem')
+        avail['mem'] = mem - used['mem'] if mem is not None else None
             
         return avail
 
@@ -409,7 +1003,8 @@ class File(object):
         :Returns:
             *resources*
                 dict giving cores not in use as a list of core numbers and gpus
-                not in use as a list of gpu ids; both lists are 0-based
+                not in use as a list of gpu ids; both lists are 0-based; free
+                host memory is given in MB (``None`` if unknown)
 
         """
         return self._avail()
@@ -419,12 +1014,195 @@ class File(object):
     def clear(self, *jobid):
         """Unclaim resources in use by given job.
 
+        Preempted jobs whose preempting job no longer holds a claim get
+        their claims back if all of their resources are free again.
+
         :Arguments:
             *jobid*
                 unique id(s) of job(s) to unclaim resources for
+
+        :Returns:
+            *restored*
+                list of jobids of preempted jobs that got their claims back
         """
+        jobs = self._record['jobs']
+        preempted = self._record.setdefault('preempted', dict())
+        waiting = self._record.setdefault('waiting', dict())
         for item in jobid:
-            self._record['jobs'].pop(item, None)
+            preempted.pop(item, None)
+            waiting.pop(item, None)
+            job = jobs.pop(item, None)
+            if job is not None:
+                self._log(History.CLEAR, item, len(job['cores']), len(job['gpus']), 0)
+
+        restored = []
+        for item in sorted(k for k, v in preempted.items()
+                           if v['by'] not in jobs and not v.get('released')):
+            job = preempted[item]
+            avail = self._avail(without=[item])
+            if (set(avail['cores']).issuperset(job['cores']) and
+                    set(avail['gpus']).issuperset(job['gpus']) and
+                    (avail['mem'] is None or avail['mem'] >= job.get('mem', 0))):
+                del preempted[item]
+                del job['by']
+                self._record['jobs'][item] = job
+                restored.append(item)
+                pinstride = job['cores'][1] - job['cores'][0] if len(job['cores']) > 1 else 1
+                self._log(History.CLAIM, item, len(job['cores']), len(job['gpus']), pinstride)
+
+        return restored
+
+    def _lendable(self):
+        """Cores and gpus of suspended jobs that are not lent out yet."""
+        lendable = dict(cores=set(), gpus=set())
+        borrowed = dict(cores=set(), gpus=set())
+        for job in self._record['jobs'].values():
+            if job.get('suspended'):
+                lendable['cores'].update(job['cores'])
+                lendable['gpus'].update(job['gpus'])
+            if 'lenders' in job:
+                borrowed['cores'].update(job['cores'])
+                borrowed['gpus'].update(job['gpus'])
+
+        return dict(cores=sorted(lendable['cores'] - borrowed['cores']),
+                    gpus=sorted(lendable['gpus'] - borrowed['gpus']))
+
+    @_read
+    @_pull
+    def lendable(self):
+        """Get resources of suspended jobs that can be lent to borrowers.
+
+        :Returns:
+            *resources*
+                dict giving lendable cores as a list of core ids and lendable
+                gpus as a list of gpu ids; both lists are 0-based
+
+        """
+        return self._lendable()
+
+    @_write
+    @_pull_push
+    def suspend(self, *jobid):
+        """Mark jobs as suspended so that their resources can be lent.
+
+        :Arguments:
+            *jobid*
+                unique id(s) of job(s) that were suspended; all jobs that
+                are not borrowers if none are given
+        """
+        jobs = self._record['jobs']
+        for item in (jobid or list(jobs.keys())):
+            if item in jobs and 'lenders' not in jobs[item]:
+                jobs[item]['suspended'] = True
+
+    @_write
+    @_pull_push
+    def resume(self, *jobid):
+        """Unmark suspended jobs whose resources are not lent out anymore.
+
+        This must be called *before* the jobs are actually resumed. Jobs
+        that still have borrowers stay marked; the borrowers have to be
+        gone and cleared before the jobs can be unmarked by calling this
+        again.
+
+        :Arguments:
+            *jobid*
+                unique id(s) of job(s) about to be resumed; all suspended
+                jobs if none are given
+
+        :Returns:
+            *borrowers*
+                list of jobids of borrowers that still hold claims on
+                resources of the jobs
+        """
+        jobs = self._record['jobs']
+        resumed = set(jobid or [k for k, v in jobs.items() if v.get('suspended')])
+        borrowers = sorted(k for k, v in jobs.items()
+                           if resumed.intersection(v.get('lenders', [])))
+        lending = set(l for k in borrowers for l in jobs[k]['lenders'])
+        for item in resumed - lending:
+            if item in jobs:
+                jobs[item].pop('suspended', None)
+
+        return borrowers
+
+    @_write
+    @_pull_push
+    @_log_refusal
+    def borrow(self, jobid, ncores, ngpus, walltime, pinstride=2, mem=0, now=None):
+        """Claim resources of suspended jobs (or free ones) for a short job.
+
+        The claim is revoked as soon as any of the suspended jobs it
+        borrows from is resumed, or after *walltime* hours.
+
+        :Arguments:
+            *jobid*
+                unique id of job claiming resources
+            *ncores*
+                number of ncores desired
+            *ngpus*
+                number of gpus desired
+            *walltime*
+                hours after which the claim expires
+            *pinstride*
+                minimum pinstride to match
+            *mem*
+                host memory desired in MB; suspended jobs keep their memory,
+                so it can only come from free memory
+            *now*
+                current time (seconds since the epoch)
+
+        :Returns:
+            *lenders*
+                list of jobids the resources were borrowed from
+        """
+        if jobid in self._record['jobs']:
+            raise KeyError("job '{}' already has resources".format(jobid))
+
+        avail = self._avail()
+        lendable = self._lendable()
+        cores = set(avail['cores']).union(lendable['cores'])
+        # prefer free gpus, then lend those of suspended jobs
+        gpus = sorted(avail['gpus']) + lendable['gpus']
+
+        if (avail['mem'] is not None and avail['mem'] < mem):
+            raise ValueError("not enough memory available")
+
+        cores_claimed = self._find_cores(cores, ncores, pinstride)
+        if not cores_claimed:
+            raise ValueError("no core config matching request could be found")
+        if (len(gpus) < ngpus):
+            raise ValueError("not enough gpus available")
+        gpus_claimed = gpus[:ngpus]
+
+        lenders = sorted(k for k, v in self._record['jobs'].items()
+                         if v.get('suspended') and
+                         (set(v['cores']).intersection(cores_claimed) or
+                          set(v['gpus']).intersection(gpus_claimed)))
+
+        now = time.time() if now is None else now
+        self._claim(jobid, cores_claimed, gpus_claimed, mem)
+        self._record.setdefault('waiting', dict()).pop(jobid, None)
+        self._record['jobs'][jobid]['lenders'] = lenders
+        self._record['jobs'][jobid]['expires'] = now + walltime * 3600
+
+        return lenders
+
+    def _expired(self, now=None):
+        now = time.time() if now is None else now
+        return [k for k, v in self._record['jobs'].items()
+                if v.get('expires', now) < now]
+
+    @_read
+    @_pull
+    def expired(self, now=None):
+        """Get jobids of borrowers whose claims have expired.
+
+        :Returns:
+            *jobids*
+                list of expired borrower jobids
+        """
+        return self._expired(now)
 
     @_read
     @_pull
@@ -442,6 +1220,17 @@ class File(object):
         """
         return self._record['jobs'][jobid]
 
+    @_read
+    @_pull
+    def resource(self):
+        """Get resources of the host.
+
+        :Returns:
+            *resource*
+                dict giving host, ncore, totcore and ngpu
+        """
+        return self._record['resource']
+
     @_read
     @_pull
     def list(self):
@@ -487,6 +1276,147 @@ class File(object):
     
         return " ".join(["{} {}".format(k, v) for k, v in params.iteritems()])
 
+class Cgroup(object):
+    """Confine jobs to their claimed resources with cgroups.
+
+    Each job gets the cgroup ``<root>/<parent>/job-<jobid>`` with a cpuset
+    of its cores. With a cgroup v1 devices hierarchy it also gets
+    ``<devices>/<parent>/job-<jobid>``, which denies access to all nvidia
+    gpus but the claimed ones; the gpu ids are taken as the minor numbers
+    of /dev/nvidia*, which match the nvidia-smi indices unless the
+    driver was told otherwise. Without it gpus are not confined.
+
+    """
+    # character device major number of /dev/nvidia*; minor 255 is
+    # /dev/nvidiactl, which every cuda process needs
+    NVIDIA_MAJOR = 195
+    NVIDIACTL = 255
+
+    def __init__(self, root='/sys/fs/cgroup', parent='semaphore', devices=None):
+        """Create Cgroup instance below the cgroup filesystem *root*.
+
+        :Arguments:
+            *root*
+                mount point of the cgroup filesystem; any directory can be
+                used for testing
+            *parent*
+                name of the cgroup that holds the job cgroups
+            *devices*
+                mount point of a cgroup v1 devices hierarchy; ``None``
+                leaves gpus unconfined
+        """
+        self.root = os.path.abspath(root)
+        self.parent = os.path.join(self.root, parent)
+        self.devices = os.path.abspath(devices) if devices else None
+        self.devices_parent = (os.path.join(self.devices, parent)
+                               if devices else None)
+
+    def path(self, jobid):
+        return os.path.join(self.parent, 'job-{}'.format(jobid))
+
+    def devices_path(self, jobid):
+        return os.path.join(self.devices_parent, 'job-{}'.format(jobid))
+
+    def _write(self, path, value):
+        with open(path, 'w') as f:
+            f.write(value)
+
+    @staticmethod
+    def cpulist(cores):
+        """Format core ids as a cpuset list, e.g. '0-3,8,10'."""
+        ranges = []
+        for core in sorted(cores):
+            if ranges and core == ranges[-1][1] + 1:
+                ranges[-1][1] = core
+            else:
+                ranges.append([core, core])
+        return ",".join(str(a) if a == b else "{}-{}".format(a, b)
+                        for a, b in ranges)
+
+    def create(self, jobid, cores, gpus=(), pids=()):
+        """Create the cgroup for a job and move processes *pids* into it.
+
+        :Arguments:
+            *jobid*
+                unique id of job
+            *cores*
+                list of core ids the job may run on
+            *gpus*
+                list of gpu ids the job may open (only with a devices
+                hierarchy)
+            *pids*
+                processes of the job; their children follow them
+        """
+        if not os.path.isdir(self.parent):
+            os.mkdir(self.parent)
+        # delegate the cpuset controller down to the job cgroups
+        for path in (self.root, self.parent):
+            self._write(os.path.join(path, 'cgroup.subtree_control'), '+cpuset')
+
+        path = self.path(jobid)
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        self._write(os.path.join(path, 'cpuset.cpus'), self.cpulist(cores))
+
+        if self.devices is not None:
+            for path in (self.devices_parent, self.devices_path(jobid)):
+                if not os.path.isdir(path):
+                    os.mkdir(path)
+            self._write(os.path.join(path, 'devices.deny'),
+                        'c {}:* rwm'.format(self.NVIDIA_MAJOR))
+            for minor in list(gpus) + [self.NVIDIACTL]:
+                self._write(os.path.join(path, 'devices.allow'),
+                            'c {}:{} rwm'.format(self.NVIDIA_MAJOR, minor))
+
+        self.attach(jobid, pids)
+
+    def attach(self, jobid, pids):
+        """Move processes *pids* into the cgroup(s) of a job."""
+        paths = [self.path(jobid)]
+        if self.devices is not None:
+            paths.append(self.devices_path(jobid))
+        for path in paths:
+            procs = os.path.join(path, 'cgroup.procs')
+            for pid in pids:
+                self._write(procs, str(pid))
+
+    def remove(self, jobid):
+        """Remove the cgroup(s) of a job; leftover processes go to the root."""
+        self._remove(self.path(jobid), self.root)
+        if self.devices is not None:
+            self._remove(self.devices_path(jobid), self.devices)
+
+    def _remove(self, path, root):
+        if not os.path.isdir(path):
+            return
+        try:
+            with open(os.path.join(path, 'cgroup.procs')) as f:
+                pids = f.read().split()
+        except IOError:
+            pids = []
+        for pid in pids:
+            try:
+                self._write(os.path.join(root, 'cgroup.procs'), pid)
+            except IOError:
+                pass
+        try:
+            os.rmdir(path)
+        except OSError as err:
+            if err.errno != errno.ENOTEMPTY:
+                raise
+            # a plain directory standing in for cgroupfs keeps the files
+            # we wrote; cgroupfs itself refuses to unlink them
+            for name in os.listdir(path):
+                os.unlink(os.path.join(path, name))
+            os.rmdir(path)
+
+    def list(self):
+        """Get jobids that have a cgroup."""
+        if not os.path.isdir(self.parent):
+            return []
+        return [name[len('job-'):] for name in os.listdir(self.parent)
+                if name.startswith('job-')]
+
 class Semaphore(object):
     """Subcommand script interface.
 
@@ -495,6 +1425,11 @@ class Semaphore(object):
         # file handle
         self.file = File('/scratch/.semaphore.yml')
 
+        # optional enforcement of claims through cgroups
+        root = os.environ.get('SEMAPHORE_CGROUP_ROOT')
+        devices = os.environ.get('SEMAPHORE_DEVICES_ROOT')
+        self.cgroup = Cgroup(root, devices=devices) if root else None
+
         parser = argparse.ArgumentParser(
             description='Query and update semaphore for this host.',
             usage=usage)
@@ -545,13 +1480,51 @@ class Semaphore(object):
         else:
             numgpu = 0
 
-        return self.file.populate(socket.gethostname(), ncore=numcores, totcore=totcores, ngpu=numgpu)
+        # get host memory in MB
+        mem = None
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    mem = int(line.split()[1]) // 1024
+
+        # get memory of each gpu in MB, if the driver tells us; gpus are
+        # identified by their nvidia-smi index (PCI bus order), and gpus
+        # the driver does not report are left at None
+        gpumem = None
+        if numgpu > 0:
+            try:
+                p = subprocess.Popen(('nvidia-smi', '--query-gpu=index,memory.total',
+                                      '--format=csv,noheader,nounits'),
+                                 stderr=subprocess.PIPE,
+                                 stdout=subprocess.PIPE)
+                out, err = p.communicate()
+                if p.returncode == 0:
+                    gpumem = [None] * numgpu
+                    for line in out.splitlines():
+                        index, total = [int(x) for x in line.split(b',')]
+                        if index < numgpu:
+                            gpumem[index] = total
+            except (OSError, ValueError):
+                gpumem = None
+
+        return self.file.populate(socket.gethostname(), ncore=numcores, totcore=totcores,
+                                  ngpu=numgpu, mem=mem, gpumem=gpumem)
+
+    @staticmethod
+    def _memory(value):
+        """Convert a memory size such as '512M' or '16G' to MB."""
+        m = re.match(r'^(\d+(?:\.\d+)?)([MGT]?)B?$', value.strip().upper())
+        if not m:
+            raise argparse.ArgumentTypeError("invalid memory size '{}'".format(value))
+        factor = {'': 1, 'M': 1, 'G': 1024, 'T': 1024**2}[m.group(2)]
+        return int(float(m.group(1)) * factor)
 
     def _purge_stale(self):
         """Purge jobs that are no longer running.
 
         """
-        p = subprocess.Popen(('qstat', '-s', 'r'),
+        # suspended jobs still own their resources
+        p = subprocess.Popen(('qstat', '-s', 'rs'),
                          stderr=subprocess.PIPE,
                          stdout=subprocess.PIPE)
         
@@ -559,7 +1532,142 @@ class Semaphore(object):
         jobids = [x.split()[0] for x in out[2:]]
 
         dead = list(set(self.file.list()) - set(jobids))
-        self.file.clear(*dead)
+        dead += list(set(self.file.preempted()) - set(jobids))
+        dead += list(set(self.file.waiting()) - set(jobids))
+        self._resume(self.file.clear(*dead))
+
+        self._revoke(self.file.expired())
+
+        # cgroups of jobs that are gone, including ones cleared elsewhere;
+        # preempted jobs keep theirs until they are restored
+        if self.cgroup is not None:
+            self._release(*(set(self.cgroup.list()) - set(self.file.list()) -
+                            set(self.file.preempted())))
+
+    def _hook(self, name, default, jobid):
+        """Run the command in environment variable *name* for *jobid*."""
+        template = os.environ.get(name, default)
+        if not template:
+            return True
+        cmd = shlex.split(template.format(jobid=jobid))
+        return subprocess.call(cmd) == 0
+
+    def _preempt(self, jobid, victims, release=False, timeout=300):
+        """Signal jobs preempted by *jobid* and wait until they stopped.
+
+        With *release* the jobs have to leave the host and are cleared
+        once they are gone. If a hook fails or the jobs still run after
+        *timeout* s the preemption is undone.
+
+        :Returns:
+            *success*
+                True if the resources of the preempted jobs are free
+        """
+        default = 'qmod -rj {jobid}' if release else 'qmod -sj {jobid}'
+        failed = [victim for victim in victims
+                  if not self._hook('SEMAPHORE_PREEMPT_HOOK', default, victim)]
+        if failed:
+            print('preemption hook failed for job(s) {}'.format(" ".join(failed)))
+
+        start = time.time()
+        while not failed:
+            p = subprocess.Popen(('qstat', '-s', 'rs' if release else 'r'),
+                             stderr=subprocess.PIPE,
+                             stdout=subprocess.PIPE)
+            out, err = p.communicate()
+            lines = [x.split() for x in out.decode('utf8').splitlines()[2:]]
+            # suspended jobs are listed with state 's' or 'S'
+            running = [x[0] for x in lines if len(x) > 4 and
+                       (release or 's' not in x[4].lower())]
+            if not set(running).intersection(victims):
+                if release:
+                    self.file.clear(*victims)
+                    self._release(*victims)
+                return True
+            if time.time() - start >= timeout:
+                print('preempted job(s) {} still running after {} s'.format(
+                    " ".join(victims), timeout))
+                break
+            time.sleep(1)
+
+        # the victims may still use the resources: give them back
+        self._resume(self.file.unpreempt(jobid))
+        return False
+
+    def _resume(self, restored):
+        """Confine jobs that got their claims back and let them run again."""
+        for jobid in restored:
+            try:
+                self._enforce(jobid, ())
+            except (IOError, OSError):
+                # the claim was given up; keep the job stopped
+                continue
+            if self._hook('SEMAPHORE_RESUME_HOOK', 'qmod -usj {jobid}', jobid):
+                print('resumed preempted job {}'.format(jobid))
+
+    def _enforce(self, jobid, pids):
+        """Confine the processes of a job to its claimed cores and gpus.
+
+        If the cgroup cannot be set up the claim is given up again, so
+        that the job does not run unconfined.
+        """
+        if self.cgroup is None:
+            return
+        resources = self.file.get(jobid)
+        try:
+            self.cgroup.create(jobid, resources['cores'], resources['gpus'],
+                               pids=pids)
+        except (IOError, OSError) as err:
+            print('could not confine job {} ({}); moving processes needs root or '
+                  'a delegated cgroup subtree'.format(jobid, err))
+            self.file.clear(jobid)
+            self._release(jobid)
+            raise
+
+    def _release(self, *jobids):
+        """Remove the cgroups of jobs."""
+        if self.cgroup is None:
+            return
+        for jobid in jobids:
+            try:
+                self.cgroup.remove(jobid)
+            except (IOError, OSError) as err:
+                print('could not remove cgroup of job {}: {}'.format(jobid, err))
+
+    def _revoke(self, jobids, timeout=60):
+        """Kill borrower jobs and clear their claims once they are gone.
+
+        Borrowers still in the queue after *timeout* s keep their claims,
+        so that a later attempt finds them again; returns ``False`` then.
+        """
+        if not jobids:
+            return True
+        subprocess.call(['qdel'] + list(jobids))
+
+        start = time.time()
+        remaining = list(jobids)
+        while True:
+            # qstat -j fails for a list as soon as one job is gone, so
+            # ask for each job separately
+            for jobid in list(remaining):
+                p = subprocess.Popen(['qstat', '-j', jobid],
+                                 stderr=subprocess.PIPE,
+                                 stdout=subprocess.PIPE)
+                p.communicate()
+                if p.returncode != 0:
+                    remaining.remove(jobid)
+            if not remaining or time.time() - start >= timeout:
+                break
+            time.sleep(1)
+
+        gone = [jobid for jobid in jobids if jobid not in remaining]
+        self._resume(self.file.clear(*gone))
+        self._release(*gone)
+        if remaining:
+            print('borrower job(s) {} still present after {} s'.format(
+                " ".join(remaining), timeout))
+            return False
+        return True
 
     def request(self):
         parser = argparse.ArgumentParser(
@@ -572,14 +1680,41 @@ class Semaphore(object):
                 help='number of gpus to request')
         parser.add_argument('--pinstride', '-p', default=2, type=int, 
                 help='minimum pinstride to use')
+        parser.add_argument('--mem', '-m', default=0, type=self._memory,
+                help='host memory to request, e.g. 512M or 16G (MB if no unit)')
+        parser.add_argument('--gpumem', default=0, type=self._memory,
+                help='memory each gpu must have, e.g. 8G (MB if no unit)')
+        parser.add_argument('--priority', default='normal', choices=sorted(PRIORITIES),
+                help='priority class of the job')
+        parser.add_argument('--preempt', action='store_true',
+                help='preempt lower-priority jobs if not enough resources are free')
+        parser.add_argument('--pid', type=int, action='append', dest='pids',
+                help='process to confine to the claim if SEMAPHORE_CGROUP_ROOT '
+                'is set; can be repeated (default: the calling process)')
         parser.add_argument('jobid', type=str, help='unique id of job')
 
-        args = parser.parse_args(sys.argv[2:])
+        args = vars(parser.parse_args(sys.argv[2:]))
+        pids = args.pop('pids') or [os.getppid()]
+        args['priority'] = PRIORITIES[args['priority']]
 
         self._populate()
         self._purge_stale()
 
-        self.file.request(**vars(args))
+        mode = os.environ.get('SEMAPHORE_PREEMPT_MODE', 'suspend')
+        if mode not in ('suspend', 'exit'):
+            parser.error("SEMAPHORE_PREEMPT_MODE must be 'suspend' or 'exit'")
+        args['release'] = mode == 'exit'
+
+        victims = self.file.request(**args)
+        if victims:
+            print('preempted job(s) {}'.format(" ".join(victims)))
+            if not self._preempt(args['jobid'], victims, release=args['release']):
+                print('preemption undone, no resources claimed')
+                sys.exit(1)
+        wait = self.file.started(args['jobid'])
+        if victims:
+            print('resources free after {:.1f} s'.format(wait))
+        self._enforce(args['jobid'], pids)
 
     def gmxify(self):
         parser = argparse.ArgumentParser(
@@ -603,7 +1738,131 @@ class Semaphore(object):
         args = parser.parse_args(sys.argv[2:])
 
         self._populate()
-        self.file.clear(*args.jobid)
+        self._resume(self.file.clear(*args.jobid))
+        self._release(*args.jobid)
+
+    def suspend(self):
+        parser = argparse.ArgumentParser(
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            description="""Mark job(s) as suspended; their resources can then be
+            borrowed by short-lived jobs.""")
+
+        parser.add_argument('jobid', help='unique id(s) of job(s); all jobs if omitted',
+                nargs='*')
+
+        args = parser.parse_args(sys.argv[2:])
+
+        self._populate()
+        self.file.suspend(*args.jobid)
+
+    def resume(self):
+        parser = argparse.ArgumentParser(
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            description="""Revoke all borrowers of suspended job(s) and unmark
+            them; run this before the jobs are resumed. Exits with status 3
+            if borrowers are still running after the timeout.""")
+
+        parser.add_argument('jobid', help='unique id(s) of job(s); all suspended jobs if omitted',
+                nargs='*')
+        parser.add_argument('--timeout', default=60, type=int,
+                help='seconds to wait for borrower jobs to disappear')
+
+        args = parser.parse_args(sys.argv[2:])
+
+        self._populate()
+        start = time.time()
+        borrowers = self.file.resume(*args.jobid)
+        while borrowers:
+            # jobs stay marked (and lendable) until all borrowers are gone,
+            # so new ones may have come in meanwhile
+            timeout = args.timeout - (time.time() - start)
+            if timeout <= 0 or not self._revoke(borrowers, timeout=timeout):
+                # the jobs must not be resumed while borrowers still run
+                sys.exit(EXIT_BORROWERS)
+            borrowers = self.file.resume(*args.jobid)
+
+    def borrow(self):
+        parser = argparse.ArgumentParser(
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            description="""Borrow resources of suspended jobs for a short job.
+            The claim (and the job) is revoked when the lending jobs are
+            resumed or the walltime runs out.""")
+
+        parser.add_argument('--ncores', '-c', default=8, type=int, 
+                help='number of cores to request')
+        parser.add_argument('--ngpus', '-g', default=1, type=int, 
+                help='number of gpus to request')
+        parser.add_argument('--pinstride', '-p', default=2, type=int, 
+                help='minimum pinstride to use')
+        parser.add_argument('--walltime', '-w', default=1, type=float, 
+                help='hours after which the claim expires')
+        parser.add_argument('--mem', '-m', default=0, type=self._memory,
+                help='host memory to request, e.g. 512M or 16G (MB if no unit)')
+        parser.add_argument('--pid', type=int, action='append', dest='pids',
+                help='process to confine to the claim if SEMAPHORE_CGROUP_ROOT '
+                'is set; can be repeated (default: the calling process)')
+        parser.add_argument('jobid', type=str, help='unique id of job')
+
+        args = vars(parser.parse_args(sys.argv[2:]))
+        pids = args.pop('pids') or [os.getppid()]
+
+        self._populate()
+        self._purge_stale()
+
+        lenders = self.file.borrow(**args)
+        self._enforce(args['jobid'], pids)
+        if lenders:
+            print('borrowed from job(s) {}'.format(" ".join(lenders)))
+
+    def history(self):
+        parser = argparse.ArgumentParser(
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            description="""Report utilization, refusals and job sizes recorded
+            in the history ledger (requires numpy).""")
+
+        parser.add_argument('--days', '-d', default=7., type=float,
+                help='length of the time window, ending now, in days')
+        parser.add_argument('--bins', '-b', default=24, type=int,
+                help='number of intervals in the utilization time series')
+
+        args = parser.parse_args(sys.argv[2:])
+
+        resource = self.file.resource()
+        stop = time.time()
+        start = stop - args.days * 86400
+        report = history_report(self.file.history.records(),
+                                resource['ncore'], resource['ngpu'],
+                                start, stop, nbins=args.bins)
+
+        def fmt(t):
+            return time.strftime('%Y-%m-%d %H:%M', time.localtime(t))
+
+        print('history of {} from {} to {}'.format(
+            resource['host'], fmt(start), fmt(stop)))
+        print('claims: {}  clears: {}  refusals: {} ({:.1%} of requests)'.format(
+            report['claims'], report['clears'], report['refusals'],
+            report['refusal_rate']))
+        print('mean utilization: cores {:.1%}  gpus {:.1%}'.format(
+            report['cores'].mean(), report['gpus'].mean()))
+        print('')
+        print('{:<18} {:>7} {:>7}'.format('from', 'cores', 'gpus'))
+        for t, c, g in zip(report['time'], report['cores'], report['gpus']):
+            print('{:<18} {:>7.1%} {:>7.1%}'.format(fmt(t), c, g))
+        print('')
+        print('job sizes (cores x gpus): ' + ', '.join(
+            '{}x{}: {}'.format(c, g, n) for (c, g), n in sorted(report['sizes'].items())))
+        print('pinstrides: ' + ', '.join(
+            '{}: {}'.format(p, n) for p, n in sorted(report['pinstrides'].items())))
+
+        stats = self.file.stats()
+        if stats:
+            print('')
+            print('time-to-start (all time):')
+            for name in sorted(stats, key=lambda k: -PRIORITIES.get(k, 0)):
+                s = stats[name]
+                print('  {:<8} {:>6} jobs, mean {:.1f} s, max {:.1f} s'.format(
+                    name, s['count'], s['wait'] / s['count'] if s['count'] else 0.,
+                    s['max']))
 
 if (__name__ == '__main__'):
     Semaphore()
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# Published under the BSD 3-clause license
+
+from __future__ import print_function
+
+usage = """Replay a trace of semaphore requests and clears against the
+allocation logic of semaphore.py and compare placement policies.
+
+The trace is either generated (--synthetic N), read from a CSV file
+with the columns
+
+    time,event,jobid,ncores,ngpus,pinstride,mem
+
+(event is 'request' or 'clear'), or taken from the history ledger of a
+semaphore (--history FILE). Nothing is locked or written to disk.
+
+"""
+import argparse
+import csv
+import random
+import time
+
+import semaphore
+
+
+class Allocator(semaphore.File):
+    """In-memory semaphore state that uses the allocation logic of File.
+
+    Only the state kept in the YAML record is replaced; requests go
+    through :meth:`semaphore.File._request` unchanged. The sets of free
+    cores and gpus are kept up to date on every claim and release instead
+    of being recomputed from all jobs.
+
+    """
+    name = 'first-fit'
+
+    def __init__(self, ncore, totcore, ngpu, mem=None, gpumem=None):
+        self.history = None
+        self._init_record()
+        self._record['resource'] = dict(host='simulation', ncore=ncore,
+                                        totcore=totcore, ngpu=ngpu,
+                                        mem=mem, gpumem=gpumem)
+        self._free_cores = set(range(totcore))
+        self._free_gpus = set(range(ngpu))
+        self._used_mem = 0
+
+    def _log(self, *args):
+        pass
+
+    def _avail(self):
+        mem = self._record['resource']['mem']
+        return dict(cores=self._free_cores,
+                    gpus=sorted(self._free_gpus),
+                    mem=mem - self._used_mem if mem is not None else None)
+
+    def _claim(self, jobid, cores, gpus, mem=0):
+        self._record['jobs'][jobid] = dict(cores=cores, gpus=gpus, mem=mem)
+        self._free_cores.difference_update(cores)
+        self._free_gpus.difference_update(gpus)
+        self._used_mem += mem
+
+    def release(self, jobid):
+        """Unclaim resources of a job; returns ``False`` if it had none."""
+        job = self._record['jobs'].pop(jobid, None)
+        if job is None:
+            return False
+        self._free_cores.update(job['cores'])
+        self._free_gpus.update(job['gpus'])
+        self._used_mem -= job['mem']
+        return True
+
+    def _candidates(self, cores, ncores, pinstride):
+        """Yield ``(stride, offset, mask, avail)`` of all fitting core sets."""
+        totcores = self._record['resource']['totcore']
+        avail = 0
+        for core in cores:
+            avail |= 1 << core
+        for i in range(pinstride, totcores//ncores + 1):
+            pattern = 0
+            for k in range(ncores):
+                pattern |= 1 << (k * i)
+            for j in range(0, totcores - (i * ncores) + i, i):
+                candidate = pattern << j
+                if candidate & avail == candidate:
+                    yield i, j, candidate, avail
+
+
+class BestFit(Allocator):
+    """Smallest stride; of its offsets the one packed tightest against
+    cores that are already in use."""
+    name = 'best-fit'
+
+    def _find_cores(self, cores, ncores, pinstride=2):
+        best = None
+        for i, j, candidate, avail in self._candidates(cores, ncores, pinstride):
+            if best is not None and i > best[1]:
+                break
+            neighbours = ((candidate << 1) | (candidate >> 1)) & ~candidate
+            score = bin(neighbours & ~avail).count('1')
+            if best is None or score > best[0]:
+                best = (score, i, j)
+        if best is None:
+            return None
+        score, i, j = best
+        return list(range(j, j + i * ncores, i))
+
+
+class RandomFit(Allocator):
+    """Smallest stride at a random fitting offset (baseline)."""
+    name = 'random-fit'
+
+    def __init__(self, *args, **kwargs):
+        super(RandomFit, self).__init__(*args, **kwargs)
+        self.random = random.Random(0)
+
+    def _find_cores(self, cores, ncores, pinstride=2):
+        fitting = []
+        for i, j, candidate, avail in self._candidates(cores, ncores, pinstride):
+            if fitting and i > fitting[0][0]:
+                break
+            fitting.append((i, j))
+        if not fitting:
+            return None
+        i, j = self.random.choice(fitting)
+        return list(range(j, j + i * ncores, i))
+
+
+POLICIES = dict((cls.name, cls) for cls in (Allocator, BestFit, RandomFit))
+
+
+def synthetic_trace(njobs, ncore, ngpu, load=0.9, seed=None, totcore=None):
+    """Generate a trace of *njobs* jobs arriving as a Poisson process.
+
+    Job sizes and pinstrides are drawn from typical requests that fit the
+    host (``ncores * pinstride <= totcore``, *totcore* defaults to
+    *ncore*), run times are exponential with mean 1. The arrival rate is
+    chosen such that the cores would be busy a fraction *load* of the
+    time.
+
+    :Returns:
+        *events*
+            list of ``(time, event, jobid, ncores, ngpus, pinstride, mem)``
+            sorted by time
+    """
+    rng = random.Random(seed)
+    totcore = totcore or ncore
+    shapes = [(c, p) for c in (1, 2, 4, 8, 16, 32) for p in (1, 2)
+              if c <= ncore and c * p <= totcore] or [(ncore, 1)]
+    gpus = [g for g in (0, 1, 2) if g <= ngpu]
+    rate = load * ncore / (sum(c for c, p in shapes) / float(len(shapes)))
+
+    events = []
+    t = 0.
+    for n in range(njobs):
+        t += rng.expovariate(rate)
+        jobid = str(n)
+        ncores, pinstride = rng.choice(shapes)
+        events.append((t, 'request', jobid, ncores, rng.choice(gpus),
+                       pinstride, 0))
+        events.append((t + rng.expovariate(1.), 'clear', jobid, 0, 0, 0, 0))
+    events.sort(key=lambda e: e[0])
+    return events
+
+
+def read_trace(filename):
+    """Read a trace from a CSV file (see :func:`write_trace`)."""
+    events = []
+    with open(filename) as f:
+        for row in csv.DictReader(f):
+            events.append((float(row['time']), row['event'], row['jobid'],
+                           int(row.get('ncores') or 0), int(row.get('ngpus') or 0),
+                           int(row.get('pinstride') or 1), int(row.get('mem') or 0)))
+    events.sort(key=lambda e: e[0])
+    return events
+
+
+def write_trace(filename, events):
+    with open(filename, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(('time', 'event', 'jobid', 'ncores', 'ngpus', 'pinstride', 'mem'))
+        writer.writerows(events)
+
+
+def history_trace(filename):
+    """Turn the history ledger of a semaphore into a trace.
+
+    Claims and refusals become requests (with the pinstride that was
+    granted, or requested), clears become clears. A refusal counts only
+    if the job was never granted later; retries of it are dropped, and
+    it gets a synthetic clear after the mean time claimed jobs held
+    their resources, so that the replay does not keep it forever.
+    """
+    history = semaphore.History(filename)
+    data = history.read()
+    size = history.RECORD.size
+    records = sorted(history.RECORD.unpack(data[i:i + size])
+                     for i in range(0, len(data) - size + 1, size))
+    last_claim = {}
+    for t, job, event, pinstride, ngpus, gpus_used, ncores, cores_used in records:
+        if event == history.CLAIM:
+            last_claim[job] = t
+
+    events = []
+    claimed = {}
+    held = []
+    refused = set()
+    for t, job, event, pinstride, ngpus, gpus_used, ncores, cores_used in records:
+        jobid = str(job)
+        if event == history.REFUSE:
+            if last_claim.get(job, t) > t or jobid in refused:
+                continue
+            refused.add(jobid)
+        elif event == history.CLAIM:
+            claimed[jobid] = t
+        elif event == history.CLEAR:
+            if jobid in claimed:
+                held.append(t - claimed.pop(jobid))
+            events.append((t, 'clear', jobid, 0, 0, 0, 0))
+            continue
+        else:
+            continue
+        events.append((t, 'request', jobid, ncores, ngpus, max(pinstride, 1), 0))
+
+    hold = sum(held) / len(held) if held else 0.
+    events.extend([(t + hold, 'clear', jobid, 0, 0, 0, 0)
+                   for t, event, jobid, ncores, ngpus, pinstride, mem in list(events)
+                   if event == 'request' and jobid in refused])
+    events.sort(key=lambda e: e[0])
+    return events
+
+
+def simulate(events, policy, ncore, totcore, ngpu, mem=None, gpumem=None):
+    """Replay *events* with the allocator class *policy*.
+
+    :Returns:
+        *results*
+            dict with the time-averaged fraction of cores and gpus in use
+            (``cores``, ``gpus``), the numbers of ``requests`` and
+            ``refusals``, the ``refusal_rate``, the ``fragmentation`` (the
+            fraction of requests refused although enough cores, gpus and
+            memory were free) and the allocator CPU time ``cpu`` in s
+    """
+    alloc = policy(ncore, totcore, ngpu, mem=mem, gpumem=gpumem)
+    reserved = totcore - ncore
+    used_cores = used_gpus = 0
+    core_area = gpu_area = 0.
+    requests = refusals = fragmented = 0
+    cpu = 0.
+    try:
+        clock = time.process_time
+    except AttributeError:
+        # Python 2
+        clock = time.clock
+    last = events[0][0] if events else 0.
+
+    for t, event, jobid, ncores, ngpus, pinstride, mem_req in events:
+        core_area += used_cores * (t - last)
+        gpu_area += used_gpus * (t - last)
+        last = t
+        if event == 'request':
+            requests += 1
+            start = clock()
+            try:
+                alloc._request(jobid, ncores, ngpus, pinstride, mem_req)
+            except (ValueError, KeyError):
+                cpu += clock() - start
+                refusals += 1
+                avail = alloc._avail()
+                if (len(avail['cores']) - reserved >= ncores and
+                        len(avail['gpus']) >= ngpus and
+                        (avail['mem'] is None or avail['mem'] >= mem_req)):
+                    fragmented += 1
+                continue
+            cpu += clock() - start
+            job = alloc._record['jobs'][jobid]
+            used_cores += len(job['cores'])
+            used_gpus += len(job['gpus'])
+        elif event == 'clear':
+            job = alloc._record['jobs'].get(jobid)
+            if job is not None:
+                used_cores -= len(job['cores'])
+                used_gpus -= len(job['gpus'])
+                alloc.release(jobid)
+
+    duration = (last - events[0][0]) if events else 0.
+    return dict(
+        cores=core_area / (duration * ncore) if duration and ncore else 0.,
+        gpus=gpu_area / (duration * ngpu) if duration and ngpu else 0.,
+        requests=requests,
+        refusals=refusals,
+        refusal_rate=float(refusals) / requests if requests else 0.,
+        fragmentation=float(fragmented) / requests if requests else 0.,
+        cpu=cpu,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=usage)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--synthetic', metavar='N', type=int,
+            help='generate a trace of N jobs')
+    source.add_argument('--trace', metavar='FILE',
+            help='read the trace from a CSV file')
+    source.add_argument('--history', metavar='FILE',
+            help='use the history ledger of a semaphore as trace')
+    parser.add_argument('--ncore', default=16, type=int,
+            help='number of cores available to the queue')
+    parser.add_argument('--totcore', default=None, type=int,
+            help='total number of cores on the host (default: NCORE)')
+    parser.add_argument('--ngpu', default=2, type=int,
+            help='number of gpus')
+    parser.add_argument('--mem', default=None, type=int,
+            help='host memory in MB (default: not limited)')
+    parser.add_argument('--load', default=0.9, type=float,
+            help='offered core load of the synthetic trace')
+    parser.add_argument('--seed', default=None, type=int,
+            help='random seed of the synthetic trace')
+    parser.add_argument('--write-trace', metavar='FILE',
+            help='save the trace as CSV')
+    parser.add_argument('--policy', '-p', action='append', choices=sorted(POLICIES),
+            help='policies to compare (default: all)')
+
+    args = parser.parse_args()
+    totcore = args.totcore or args.ncore
+
+    if args.synthetic is not None:
+        events = synthetic_trace(args.synthetic, args.ncore, args.ngpu,
+                                 load=args.load, seed=args.seed, totcore=totcore)
+    elif args.trace:
+        events = read_trace(args.trace)
+    else:
+        events = history_trace(args.history)
+    if args.write_trace:
+        write_trace(args.write_trace, events)
+
+    print('{} events, {} cores ({} total), {} gpus'.format(
+        len(events), args.ncore, totcore, args.ngpu))
+    print('{:<12} {:>7} {:>7} {:>9} {:>9} {:>10} {:>10}'.format(
+        'policy', 'cores', 'gpus', 'refused', 'fragment', 'cpu [s]', 'us/req'))
+    for name in args.policy or sorted(POLICIES):
+        r = simulate(events, POLICIES[name], args.ncore, totcore, args.ngpu,
+                     mem=args.mem)
+        print('{:<12} {:>7.1%} {:>7.1%} {:>9.2%} {:>9.2%} {:>10.3f} {:>10.1f}'.format(
+            name, r['cores'], r['gpus'], r['refusal_rate'], r['fragmentation'],
+            r['cpu'], 1e6 * r['cpu'] / r['requests'] if r['requests'] else 0.))
+
+if (__name__ == '__main__'):
+    main()